@@ -0,0 +1,480 @@
+import io
+import os
+import sys
+import json
+import time
+import random
+import socket
+import argparse
+import tempfile
+import threading
+import contextlib
+import collections
+import multiprocessing
+
+from concurrent.futures import ProcessPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+import requests
+import pandas as pd
+
+import requestgtrend
+from requestgtrend import GtrendReq, ProxyPool, Metrics, fetch_keyword
+
+
+def explore_payload(comparison_items):
+    """Canned explore response: one TIMESERIES/GEO_MAP widget plus related widgets per keyword"""
+    keywords = [item['keyword'] for item in comparison_items]
+    comparison = [{'geo': {}, 'complexKeywordsRestriction': {'keyword': [{'type': 'BROAD', 'value': kw}]}}
+                  for kw in keywords]
+    widgets = [
+        {'id': 'TIMESERIES', 'token': 'timeseries-token', 'title': 'Interest over time',
+         'request': {'time': comparison_items[0]['time'], 'resolution': 'WEEK', 'comparisonItem': comparison}},
+        {'id': 'GEO_MAP', 'token': 'geo-token', 'request': {'resolution': 'COUNTRY', 'comparisonItem': comparison}},
+    ]
+    suffix = [''] if len(keywords) == 1 else ['_{}'.format(idx) for idx in range(len(keywords))]
+    for kw, tail in zip(keywords, suffix):
+        restriction = {'complexKeywordsRestriction': {'keyword': [{'type': 'BROAD', 'value': kw}]}}
+        widgets.append({'id': 'RELATED_TOPICS' + tail, 'token': 'topics-token',
+                        'request': {'restriction': restriction, 'keywordType': 'ENTITY'}})
+        widgets.append({'id': 'RELATED_QUERIES' + tail, 'token': 'queries-token',
+                        'request': {'restriction': restriction, 'keywordType': 'QUERY'}})
+    return {'widgets': widgets}
+
+
+def multiline_payload(request_json, points=261, step=604800):
+    """Canned multiline response, weekly points (``step`` seconds apart) with the last one partial"""
+    n = max(len(request_json.get('comparisonItem', [])), 1)
+    start = 1500000000
+    timeline = [{'time': str(start + step * idx), 'formattedTime': str(idx), 'formattedAxisTime': str(idx),
+                 'value': [random.randint(0, 100) for _ in range(n)], 'hasData': [True] * n,
+                 'formattedValue': ['0'] * n} for idx in range(points)]
+    timeline[-1]['isPartial'] = True
+    return {'default': {'timelineData': timeline, 'averages': []}}
+
+
+def relatedsearches_payload(request_json, top=25, rising=10):
+    """Canned relatedsearches response (topics or queries) for the keyword of the widget restriction"""
+    kw = request_json['restriction']['complexKeywordsRestriction']['keyword'][0]['value']
+
+    def ranked(count):
+        if request_json.get('keywordType') == 'QUERY':
+            return [{'query': '{} query {}'.format(kw, idx), 'value': 100 - idx, 'formattedValue': str(100 - idx),
+                     'hasData': True, 'link': '/trends/explore?q={}'.format(idx)} for idx in range(count)]
+        return [{'topic': {'mid': '/m/{}'.format(idx), 'title': '{} topic {}'.format(kw, idx), 'type': 'Topic'},
+                 'value': 100 - idx, 'formattedValue': str(100 - idx), 'hasData': True,
+                 'link': '/trends/explore?q=/m/{}'.format(idx)} for idx in range(count)]
+
+    return {'default': {'rankedList': [{'rankedKeyword': ranked(top)}, {'rankedKeyword': ranked(rising)}]}}
+
+
+def comparedgeo_payload(request_json, regions=50):
+    """Canned comparedgeo response, one value per keyword for each region"""
+    n = max(len(request_json.get('comparisonItem', [])), 1)
+    return {'default': {'geoMapData': [
+        {'geoCode': 'R{:02d}'.format(idx), 'geoName': 'Region {}'.format(regions - idx),
+         'value': [random.randint(0, 100) for _ in range(n)], 'formattedValue': ['0'] * n,
+         'maxValueIndex': 0, 'hasData': [True] * n} for idx in range(regions)]}}
+
+
+class StubTrendsServer:
+    """Local stand-in for trends.google.com serving canned explore/multiline/relatedsearches/comparedgeo payloads
+
+    ``latency`` seconds are added to every response and ``error_rate`` of the requests are answered
+    with a 429. ``connect_latency`` seconds are added once per new connection, standing in for the
+    TCP and TLS handshakes with the real host that a loopback connection does not pay.
+    The server also accepts absolute request URIs, so it can be used as an HTTP proxy.
+    """
+
+    def __init__(self, latency=0.0, error_rate=0.0, connect_latency=0.0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.connect_latency = connect_latency
+        self.requests = 0
+        self.lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # headers and body are written separately, avoid delayed-ACK stalls on keep-alive connections
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def setup(self):
+                super().setup()
+                if stub.connect_latency:
+                    time.sleep(stub.connect_latency)
+
+            def do_GET(self):
+                stub.handle(self)
+
+            do_POST = do_GET
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.httpd.daemon_threads = True
+        self.url = 'http://127.0.0.1:{}'.format(self.httpd.server_port)
+
+    def __enter__(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def handle(self, handler):
+        with self.lock:
+            self.requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+        parsed = urlparse(handler.path)
+        if self.error_rate and random.random() < self.error_rate:
+            self.send(handler, 429, 'text/html', 'Too Many Requests')
+            return
+        request_json = json.loads(parse_qs(parsed.query)['req'][0])
+        if parsed.path.endswith('/explore'):
+            body = ")]}'\n" + json.dumps(explore_payload(request_json['comparisonItem']))
+        elif parsed.path.endswith('/multiline'):
+            body = ")]}',\n" + json.dumps(multiline_payload(request_json))
+        elif parsed.path.endswith('/comparedgeo'):
+            body = ")]}',\n" + json.dumps(comparedgeo_payload(request_json))
+        else:
+            body = ")]}',\n" + json.dumps(relatedsearches_payload(request_json))
+        self.send(handler, 200, 'application/json; charset=utf-8', body)
+
+    @staticmethod
+    def send(handler, status, content_type, body):
+        data = body.encode('utf-8')
+        handler.send_response(status)
+        handler.send_header('Content-Type', content_type)
+        handler.send_header('Content-Length', str(len(data)))
+        handler.end_headers()
+        handler.wfile.write(data)
+
+
+def stub_endpoints(base_url):
+    """GtrendReq endpoint attributes pointing at a StubTrendsServer"""
+    return {
+        'GENERAL_URL': base_url + '/trends/api/explore',
+        'INTEREST_OVER_TIME_URL': base_url + '/trends/api/widgetdata/multiline',
+        'RELATED_QUERIES_URL': base_url + '/trends/api/widgetdata/relatedsearches',
+        'INTEREST_BY_REGION_URL': base_url + '/trends/api/widgetdata/comparedgeo',
+    }
+
+
+def stub_client_class(base_url):
+    """GtrendReq subclass whose endpoints point at a StubTrendsServer"""
+    return type('StubGtrendReq', (GtrendReq,), stub_endpoints(base_url))
+
+
+def report(name, samples):
+    samples = sorted(samples)
+    mean = sum(samples) / len(samples)
+    p50 = samples[len(samples) // 2]
+    p99 = samples[min(int(len(samples) * 0.99), len(samples) - 1)]
+    print('{:<28} mean {:7.2f} ms   p50 {:7.2f} ms   p99 {:7.2f} ms'.format(name, mean * 1e3, p50 * 1e3, p99 * 1e3))
+    return mean
+
+
+def bench_session(args):
+    """Per-request latency of a fresh connection per call (old _get_data) against the pooled session"""
+    with StubTrendsServer(latency=args.latency, connect_latency=args.connect_latency) as server:
+        trends = stub_client_class(server.url)()
+        with contextlib.redirect_stdout(io.StringIO()):
+            trends.build_payload(['benchmark'])
+        params = {'hl': trends.hl, 'tz': trends.tz, 'token': 'timeseries-token',
+                  'req': json.dumps(trends.interest_over_time_widget['request'], separators=(',', ':'))}
+
+        def timed(call):
+            samples = list()
+            for _ in range(args.requests):
+                start = time.perf_counter()
+                call()
+                samples.append(time.perf_counter() - start)
+            return samples
+
+        bare = report('requests.get', timed(lambda: requests.get(trends.INTEREST_OVER_TIME_URL, params=params,
+                                                                  timeout=(50, 60))))
+        session = trends._session(None)
+        pooled = report('pooled session', timed(lambda: session.get(trends.INTEREST_OVER_TIME_URL, params=params,
+                                                                    timeout=(50, 60))))
+        with contextlib.redirect_stdout(io.StringIO()):
+            samples = timed(lambda: trends._get_data(trends.INTEREST_OVER_TIME_URL, params, trim_chars=5))
+        report('GtrendReq._get_data', samples)
+        trends.close()
+        print('pooled/bare: {:.2f}'.format(pooled / bare))
+
+
+def legacy_parse_interest_over_time(req_json, kw_list):
+    """interest_over_time() parsing before it was vectorized, kept as the reference implementation"""
+    df = pd.DataFrame(req_json['default']['timelineData'])
+    if (df.empty):
+        return df
+
+    df['date'] = pd.to_datetime(df['time'].astype(dtype='float64'),
+                                unit='s')
+    df = df.set_index(['date']).sort_index()
+    result_df = df['value'].apply(lambda x: pd.Series(
+        str(x).replace('[', '').replace(']', '').split(',')))
+    for idx, kw in enumerate(kw_list):
+        result_df.insert(len(result_df.columns), kw,
+                         result_df[idx].astype('int'))
+        del result_df[idx]
+
+    if 'isPartial' in df:
+        df = df.fillna(False)
+        result_df2 = df['isPartial'].apply(lambda x: pd.Series(
+            str(x).replace('[', '').replace(']', '').split(',')))
+        result_df2.columns = ['isPartial']
+        result_df2.isPartial = result_df2.isPartial == 'True'
+        final = pd.concat([result_df, result_df2], axis=1)
+    else:
+        final = result_df
+        final['isPartial'] = False
+
+    return final
+
+
+def bench_parse(args):
+    """Legacy per-row interest_over_time parsing against the vectorized one on payloads of several sizes"""
+    payloads = list()
+    for path in args.payload:
+        # recorded multiline responses, with or without the leading ")]}'," garbage
+        with open(path, encoding='utf-8') as fd:
+            text = fd.read()
+        req_json = json.loads(text[text.index('{'):])
+        width = len(req_json['default']['timelineData'][0]['value'])
+        payloads.append((path, ['kw{}'.format(idx) for idx in range(width)], req_json))
+    if not payloads:
+        for name, points, step, width in (('today 12-m', 53, 604800, 1), ('today 5-y', 261, 604800, 1),
+                                          ('today 5-y x5', 261, 604800, 5), ('today 3-m x5', 90, 86400, 5),
+                                          ('all x5', 1000, 2629746, 5), ('daily stitch x5', 5000, 86400, 5)):
+            request_json = {'comparisonItem': [{}] * width}
+            payloads.append((name, ['kw{}'.format(idx) for idx in range(width)],
+                             multiline_payload(request_json, points, step)))
+
+    trends = GtrendReq()
+    print('{:<22}{:>8}{:>14}{:>14}{:>10}'.format('payload', 'points', 'legacy ms', 'numpy ms', 'speedup'))
+    for name, kw_list, req_json in payloads:
+        trends.kw_list = kw_list
+        expected = legacy_parse_interest_over_time(req_json, kw_list)
+        # column index dtype may differ (object vs string) on newer pandas
+        pd.testing.assert_frame_equal(trends._parse_interest_over_time(req_json), expected, check_column_type=False)
+
+        def timed(call):
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                call()
+            return (time.perf_counter() - start) / args.repeat
+
+        legacy = timed(lambda: legacy_parse_interest_over_time(req_json, kw_list))
+        vectorized = timed(lambda: trends._parse_interest_over_time(req_json))
+        print('{:<22}{:>8}{:>14.3f}{:>14.3f}{:>9.1f}x'.format(name, len(req_json['default']['timelineData']),
+                                                           legacy * 1e3, vectorized * 1e3, legacy / vectorized))
+
+
+def closed_port_url():
+    """URL of a local port nothing listens on, stands in for a dead proxy"""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return 'http://127.0.0.1:{}'.format(sock.getsockname()[1])
+
+
+def bench_proxy(args):
+    """Random proxy per keyword (old main) against ProxyPool on stub proxies of mixed health"""
+    specs = (('fast', 0.01, 0.0), ('slow', args.slow, 0.0), ('throttled', 0.01, args.error_rate))
+    keywords = ['kw{}'.format(idx) for idx in range(args.keywords)]
+    with contextlib.ExitStack() as stack:
+        servers = [stack.enter_context(StubTrendsServer(latency, error_rate)) for _, latency, error_rate in specs]
+        names = {server.url: name for server, (name, _, _) in zip(servers, specs)}
+        if args.dead:
+            names[closed_port_url()] = 'dead'
+        proxies = list(names)
+        # the stub proxies answer the absolute URIs themselves, the host is never resolved
+        client_class = stub_client_class('http://trends.stub')
+
+        def run(label, trends, switch):
+            before = [server.requests for server in servers]
+            ok = 0
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                for kw in keywords:
+                    if switch:
+                        trends.proxy = random.choice(proxies)
+                    ok += fetch_keyword(trends, kw, pause=False).done
+            elapsed = time.perf_counter() - start
+            trends.close()
+            served = ', '.join('{} {}'.format(name, server.requests - count)
+                               for (name, _, _), server, count in zip(specs, servers, before))
+            print('{:<10} {:7.2f} s  {:6.2f} kw/s  ok {}/{}  served: {}'.format(
+                label, elapsed, len(keywords) / elapsed, ok, len(keywords), served))
+
+        run('random', client_class(retries=args.retries), switch=True)
+        pool = ProxyPool(proxies, cooldown=args.cooldown, failures=args.failures)
+        run('pool', client_class(retries=args.retries, pool=pool), switch=False)
+        for line in pool.summary():
+            proxy = line.split(': ')[0]
+            print('  {:<10}{}'.format(names[proxy], line[len(proxy) + 2:]))
+
+
+class SampledMetrics(Metrics):
+    """Metrics that also keeps every request latency and stage duration, for exact percentiles"""
+
+    def __init__(self):
+        super().__init__()
+        self.samples = collections.defaultdict(list)
+
+    def request(self, url, proxy, attempt, status_code, outcome, elapsed, size):
+        super().request(url, proxy, attempt, status_code, outcome, elapsed, size)
+        with self.lock:
+            self.samples['network'].append(elapsed)
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try:
+            with super().timer(stage):
+                yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.samples[stage].append(elapsed)
+
+
+# how the recorded stages add up to the time split of a pipeline run; 'chart' and 'topics_xlsx' are
+# per-keyword samples inside 'charts' and 'excel', for their percentiles, and are not added again
+PIPELINE_GROUPS = (('network', ('network',)), ('parsing', ('json', 'interest_over_time', 'related_topics')),
+                   ('charts', ('charts',)), ('excel', ('excel',)))
+
+
+def percentile(samples, q):
+    samples = sorted(samples)
+    return samples[min(int(len(samples) * q), len(samples) - 1)] if samples else None
+
+
+def peak_memory_mb():
+    """Peak resident memory of this process (MB); the traced Python heap peak where resource is missing"""
+    try:
+        import resource
+    except ImportError:  # Windows
+        import tracemalloc
+        return tracemalloc.get_traced_memory()[1] / 2 ** 20 if tracemalloc.is_tracing() else None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+
+
+def run_pipeline(size, proxies, options):
+    """collect + export of ``size`` keywords against the stub proxies, in a fresh process so memory is its own"""
+    if 'resource' not in sys.modules and sys.platform == 'win32':
+        import tracemalloc
+        tracemalloc.start()
+    # the stub proxies answer the absolute URIs themselves, the host is never resolved
+    for name, url in stub_endpoints('http://trends.stub').items():
+        setattr(GtrendReq, name, url)
+    config = dict(options, https_proxy=proxies, hl='en-US', tz=360, retries=options['retries'])
+    keywords = ['keyword {}'.format(idx) for idx in range(size)]
+    df_subj = pd.DataFrame({'主题': keywords})
+    metrics = SampledMetrics()
+    with tempfile.TemporaryDirectory() as workdir, contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        store, metrics, run = requestgtrend.collect(config, keywords, workdir, metrics=metrics)
+        collected = time.perf_counter() - start
+        requestgtrend.export(config, store, metrics, workdir, df_subj)
+        elapsed = time.perf_counter() - start
+        store.close()
+    stages = {stage: {'count': len(samples), 'seconds': sum(samples), 'p50': percentile(samples, 0.5),
+                      'p99': percentile(samples, 0.99)} for stage, samples in metrics.samples.items()}
+    return {'keywords': size, 'failed': run['failed'], 'seconds': elapsed, 'collect_seconds': collected,
+            'keywords_per_second': size / elapsed, 'peak_memory_mb': peak_memory_mb(), 'stages': stages,
+            'split': {group: sum(stages[stage]['seconds'] for stage in names if stage in stages)
+                      for group, names in PIPELINE_GROUPS}}
+
+
+def bench_pipeline(args):
+    """Whole request-to-report pipeline (collect + charts + Excel) on sheets of several sizes"""
+    options = {'workers': args.workers, 'async': args.use_async, 'concurrency': args.concurrency,
+               'retries': args.retries, 'backoff_base': args.backoff, 'backoff_cap': args.backoff * 8,
+               'proxy_cooldown': 1, 'pause': False, 'charts': args.charts, 'chart_workers': args.chart_workers,
+               'export_xlsx': not args.no_topics_xlsx}
+    results = list()
+    # one stub server per worker: each stands in for a proxy, and ProxyPool keeps one entry per proxy
+    with contextlib.ExitStack() as stack:
+        servers = [stack.enter_context(StubTrendsServer(args.latency, args.error_rate))
+                   for _ in range(max(args.workers, 1))]
+        proxies = [server.url for server in servers]
+        print('{:>7}{:>9}{:>9}{:>9}{:>9}{:>9}{:>10}{:>10}{:>10}{:>10}{:>8}'.format(
+            'size', 'kw/s', 'total s', 'net s', 'parse s', 'chart s', 'excel s', 'net p99', 'parse p99',
+            'peak MB', 'failed'))
+        for size in args.sizes:
+            # spawn: a clean interpreter per size, so the peak memory is not carried over from the previous one
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+                result = executor.submit(run_pipeline, size, proxies, options).result()
+            results.append(result)
+            stages, split = result['stages'], result['split']
+            parse_p99 = max((stages[stage]['p99'] for stage in PIPELINE_GROUPS[1][1] if stage in stages), default=0)
+            print('{:>7}{:>9.2f}{:>9.1f}{:>9.1f}{:>9.1f}{:>9.1f}{:>10.1f}{:>8.1f}ms{:>8.2f}ms{:>10}{:>8}'.format(
+                size, result['keywords_per_second'], result['seconds'], split['network'], split['parsing'],
+                split['charts'], split['excel'], stages.get('network', {}).get('p99', 0) * 1e3, parse_p99 * 1e3,
+                '-' if result['peak_memory_mb'] is None else '{:.0f}'.format(result['peak_memory_mb']),
+                result['failed']))
+            if args.verbose:
+                for stage, stats in sorted(stages.items()):
+                    print('        {:<20}{:>8} x  p50 {:8.2f} ms  p99 {:8.2f} ms  total {:8.2f} s'.format(
+                        stage, stats['count'], stats['p50'] * 1e3, stats['p99'] * 1e3, stats['seconds']))
+    # network and parsing are summed over all threads, so with concurrency they can exceed the total
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as fd:
+            json.dump({'options': dict(options, latency=args.latency, error_rate=args.error_rate),
+                       'results': results}, fd, indent=2)
+        print('saved to {}'.format(args.save))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='requestgtrend benchmarks against a local stub Trends server')
+    sub = parser.add_subparsers(dest='bench', required=True)
+    session = sub.add_parser('session', help='keep-alive session against a new connection per request')
+    session.add_argument('--requests', type=int, default=200)
+    session.add_argument('--latency', type=float, default=0.0, help='server-side latency per response (s)')
+    session.add_argument('--connect-latency', type=float, default=0.05,
+                         help='simulated TCP+TLS handshake per new connection (s), 0 for plain loopback')
+    session.set_defaults(func=bench_session)
+    parse = sub.add_parser('parse', help='interest_over_time timeline parsing')
+    parse.add_argument('--repeat', type=int, default=20)
+    parse.add_argument('--payload', action='append', default=[], help='recorded multiline response (repeatable)')
+    parse.set_defaults(func=bench_parse)
+    proxy = sub.add_parser('proxy', help='random proxy switching against ProxyPool on stub proxies')
+    proxy.add_argument('--keywords', type=int, default=12)
+    proxy.add_argument('--retries', type=int, default=2)
+    proxy.add_argument('--slow', type=float, default=0.3, help='latency of the slow proxy (s)')
+    proxy.add_argument('--error-rate', type=float, default=0.5, help='429 rate of the throttled proxy')
+    proxy.add_argument('--no-dead', dest='dead', action='store_false', help='leave out the dead proxy')
+    proxy.add_argument('--cooldown', type=float, default=60)
+    proxy.add_argument('--failures', type=int, default=3)
+    proxy.set_defaults(func=bench_proxy)
+    pipeline = sub.add_parser('pipeline', help='collect, charts and Excel export on sheets of several sizes')
+    pipeline.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000, 10000])
+    pipeline.add_argument('--workers', type=int, default=4,
+                          help='threads, one stub proxy each; the 1-3 s pause between keywords is switched off')
+    pipeline.add_argument('--async', dest='use_async', action='store_true', help='AsyncGtrendReq instead of threads')
+    pipeline.add_argument('--concurrency', type=int, default=50, help='keywords in flight in --async mode')
+    pipeline.add_argument('--latency', type=float, default=0.0, help='server-side latency per response (s)')
+    pipeline.add_argument('--error-rate', type=float, default=0.0, help='share of responses that are 429s')
+    pipeline.add_argument('--retries', type=int, default=3)
+    pipeline.add_argument('--backoff', type=float, default=0.05, help='retry backoff base (s)')
+    pipeline.add_argument('--charts', choices=requestgtrend.CHART_FORMATS, default='files')
+    pipeline.add_argument('--chart-workers', type=int, default=1,
+                          help='processes drawing the charts; above 1 the per-chart samples are not recorded')
+    pipeline.add_argument('--no-topics-xlsx', action='store_true', help='skip the per-keyword related topics xlsx')
+    pipeline.add_argument('--save', help='write all results as JSON, e.g. to compare runs before and after a change')
+    pipeline.add_argument('-v', '--verbose', action='store_true', help='p50/p99 of every stage')
+    pipeline.set_defaults(func=bench_pipeline)
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,632 @@
 import os
+import re
+import sys
+import copy
 import time
 import json
+import queue
+import asyncio
+import zlib
 import random
+import sqlite3
+import hashlib
+import functools
+import contextlib
+import itertools
+import dataclasses
+import enum
+import threading
 
 import requests
+import numpy as np
 import pandas as pd
-import plotly.offline
-import plotly.graph_objects as go
 
+from collections import OrderedDict
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 from urllib.parse import urlencode
-from pandas.io.json._normalize import nested_to_record
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+
+# plotly, openpyxl and aiohttp are slow to import and only some runs need them: they are imported by the
+# stage that uses them (charts, Excel export, AsyncGtrendReq)
+aiohttp = None
+URL = None
+
+
+def _import_aiohttp():
+    """Import aiohttp and yarl on first use, ImportError if they are not installed"""
+    global aiohttp, URL
+    if aiohttp is None:
+        from yarl import URL
+        import aiohttp
+    return aiohttp
+
+
+class TokenBucket:
+    """Thread-safe token bucket: ``rate`` requests per second with bursts of up to ``capacity``
+
+    A rate of 0 (or less) disables limiting.
+    """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = float(rate)
+        self.capacity = max(float(capacity), 1.0)
+        self.tokens = self.capacity
+        self.timestamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _take(self):
+        """Take a token if one is available, otherwise return the seconds to wait for the next one"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.timestamp) * self.rate)
+            self.timestamp = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        """Block until a token is available and take it"""
+        if self.rate <= 0:
+            return
+        while True:
+            wait = self._take()
+            if not wait:
+                return
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        """Coroutine version of acquire() that waits without blocking the event loop"""
+        if self.rate <= 0:
+            return
+        while True:
+            wait = self._take()
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+
+class TokenCache:
+    """TTL-bounded LRU cache of explore widgets keyed by the canonical prepare_post_url
+
+    Widgets are kept in memory; with ``path`` they are also loaded from and saved to a JSON file
+    so a rerun can skip the explore POSTs of keywords it already explored.
+    """
+
+    def __init__(self, ttl=3600, maxsize=1024, path=None):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        # key -> (expiry timestamp, widget dicts), least recently used first
+        self.entries = OrderedDict()
+        if path and os.path.exists(path):
+            with open(path, encoding='utf-8') as fd:
+                now = time.time()
+                for key, (expires, widgets) in json.load(fd).items():
+                    if expires > now:
+                        self.entries[key] = (expires, widgets)
+
+    def get(self, key):
+        """Cached widgets for ``key`` or None if missing or expired"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] <= time.time():
+                self.entries.pop(key, None)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, widgets):
+        with self.lock:
+            self.entries[key] = (time.time() + self.ttl, widgets)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def save(self):
+        """Write the unexpired entries to ``path`` (no-op without a path)"""
+        if not self.path:
+            return
+        with self.lock:
+            now = time.time()
+            entries = {key: entry for key, entry in self.entries.items() if entry[0] > now}
+        with open(self.path + '.tmp', 'w', encoding='utf-8') as fd:
+            json.dump(entries, fd, ensure_ascii=False)
+        os.replace(self.path + '.tmp', self.path)
+
+
+class ProxyPool:
+    """Proxies picked per request, weighted by their observed health
+
+    Every proxy keeps a latency average, its success rate and its 429 count. choose() draws a
+    ready proxy with probability proportional to success rate / latency. A proxy that fails
+    ``failures`` times in a row (any RetryPolicy.RETRYABLE outcome) is put in cooldown for
+    ``cooldown`` seconds, doubled on every trip, and a single failure after a cooldown trips it
+    again. Each proxy also has its own TokenBucket of ``rate`` requests per second.
+    """
+
+    # an EWMA of the latency, weight of the newest sample
+    LATENCY_ALPHA = 0.2
+
+    def __init__(self, proxies, rate=0, burst=1, cooldown=60, failures=3):
+        self.proxies = list(dict.fromkeys(proxies))
+        if not self.proxies:
+            raise ValueError('ProxyPool needs at least one proxy')
+        self.cooldown = cooldown
+        self.failures = max(failures, 1)
+        self.lock = threading.Lock()
+        self.limiters = {proxy: TokenBucket(rate, burst) for proxy in self.proxies}
+        self.stats = {proxy: {'requests': 0, 'ok': 0, 'throttled': 0, 'errors': 0, 'latency': None,
+                              'streak': 0, 'trips': 0, 'until': 0.0} for proxy in self.proxies}
+
+    def choose(self, exclude=()):
+        """Pick the proxy of the next request, avoiding ``exclude`` (e.g. the proxy that just failed) if possible"""
+        with self.lock:
+            now = time.monotonic()
+            candidates = [proxy for proxy in self.proxies if proxy not in exclude] or self.proxies
+            ready = [proxy for proxy in candidates if self.stats[proxy]['until'] <= now]
+            if not ready:
+                # every candidate is cooling down, probe the one that recovers first
+                return min(candidates, key=lambda proxy: self.stats[proxy]['until'])
+            # proxies without a latency sample yet are assumed as fast as the fastest one, so they get tried
+            measured = [self.stats[proxy]['latency'] for proxy in self.proxies if self.stats[proxy]['latency']]
+            default = min(measured) if measured else 1.0
+            weights = list()
+            for proxy in ready:
+                stats = self.stats[proxy]
+                success = (stats['ok'] + 1) / (stats['requests'] + 2)
+                weights.append(success / max(stats['latency'] or default, 0.001))
+            return random.choices(ready, weights)[0]
+
+    def limiter(self, proxy):
+        return self.limiters[proxy]
+
+    def record(self, proxy, outcome, elapsed):
+        """Record the RetryPolicy outcome of a request through ``proxy``"""
+        with self.lock:
+            stats = self.stats[proxy]
+            stats['requests'] += 1
+            if outcome != 'network':
+                if stats['latency'] is None:
+                    stats['latency'] = elapsed
+                else:
+                    stats['latency'] += self.LATENCY_ALPHA * (elapsed - stats['latency'])
+            if outcome not in RetryPolicy.RETRYABLE:
+                # fatal answers (400/404...) come from Google, the proxy itself worked
+                stats['ok'] += 1
+                stats['streak'] = 0
+                stats['trips'] = 0
+                return
+            if outcome in ('throttled', 'captcha'):
+                stats['throttled'] += 1
+            else:
+                stats['errors'] += 1
+            stats['streak'] += 1
+            if stats['streak'] >= self.failures or stats['trips']:
+                pause = self.cooldown * 2 ** min(stats['trips'], 4)
+                stats['trips'] += 1
+                stats['streak'] = 0
+                stats['until'] = time.monotonic() + pause
+                print("代理{}连续失败, 暂停使用{}秒".format(proxy, pause))
+
+    def summary(self):
+        """One line per proxy with its request count, success rate, 429/captcha count and average latency"""
+        with self.lock:
+            lines = list()
+            for proxy in self.proxies:
+                stats = self.stats[proxy]
+                lines.append("{}: 请求{}次, 成功率{:.0%}, 429/验证码 {}次, 其他异常{}次, 平均延迟{}".format(
+                    proxy, stats['requests'], stats['ok'] / max(stats['requests'], 1), stats['throttled'],
+                    stats['errors'], "{:.2f}s".format(stats['latency']) if stats['latency'] is not None else "-"))
+            return lines
+
+
+class RetryPolicy:
+    """Classifies the outcome of a request and decides whether and when to retry it
+
+    Outcomes are 'ok', 'fatal' (400/401/404..., or a 200 that is not JSON) and the retryable
+    'throttled' (429), 'server' (5xx), 'network' (timeouts, proxy and connection errors) and
+    'captcha' (Google's HTML "unusual traffic" page). The backoff is exponential with jitter and
+    honours Retry-After; it is skipped for failures tied to the proxy when the retry goes out
+    through another one. ``deadline`` bounds the seconds spent on one keyword, timeouts included.
+    """
+
+    RETRYABLE = ('throttled', 'server', 'network', 'captcha')
+    # failures caused by the proxy's IP or connection rather than by Google itself
+    PROXY_BOUND = ('throttled', 'network', 'captcha')
+    CAPTCHA_MARKERS = ('captcha', 'unusual traffic', '/sorry/')
+    # Google mostly sends 'application/json', but occasionally 'application/javascript' or 'text/javascript'
+    JSON_TYPES = ('application/json', 'application/javascript', 'text/javascript')
+    NETWORK_ERRORS = (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                      requests.exceptions.ChunkedEncodingError, asyncio.TimeoutError)
+
+    def __init__(self, base=1.0, cap=30.0, deadline=180, connect_timeout=10, read_timeout=30):
+        self.base = base
+        self.cap = cap
+        self.deadline = deadline
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+
+    def classify(self, status_code=None, content_type='', text='', error=None):
+        """Outcome of a response, or of the exception ``error`` raised instead of one"""
+        if error is not None:
+            errors = self.NETWORK_ERRORS
+            if aiohttp is not None:  # imported once an AsyncGtrendReq exists
+                errors += (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError)
+            return 'network' if isinstance(error, errors) else 'fatal'
+        if status_code == 429:
+            return 'throttled'
+        if status_code >= 500:
+            return 'server'
+        if 'text/html' in content_type:
+            page = text.lower()
+            if any(marker in page for marker in self.CAPTCHA_MARKERS):
+                return 'captcha'
+        if status_code == 200 and any(json_type in content_type for json_type in self.JSON_TYPES):
+            return 'ok'
+        return 'fatal'
+
+    def delay(self, attempt, outcome, retry_after=None, switch=False):
+        """Seconds to wait before retry number ``attempt`` + 1; ``switch``: the retry uses another proxy"""
+        if switch and outcome in self.PROXY_BOUND:
+            return 0.0
+        wait = self.parse_retry_after(retry_after)
+        if wait is not None:
+            return wait
+        # equal jitter: half of the exponential step is fixed, the other half random
+        step = min(self.cap, self.base * 2 ** attempt)
+        return step / 2 + random.uniform(0, step / 2)
+
+    def timeout(self, remaining=None):
+        """(connect, read) timeouts of the next request, bounded by the seconds left before the deadline"""
+        if remaining is None:
+            return self.connect_timeout, self.read_timeout
+        return min(self.connect_timeout, remaining), min(self.read_timeout, remaining)
+
+    @staticmethod
+    def parse_retry_after(value):
+        """Seconds of a Retry-After header (delta-seconds or HTTP date), None if missing or malformed"""
+        if not value:
+            return None
+        try:
+            return max(float(value), 0.0)
+        except ValueError:
+            pass
+        try:
+            return max((parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds(), 0.0)
+        except (TypeError, ValueError):
+            return None
+
+
+class Metrics:
+    """Thread-safe counters and timings of every request made by the clients sharing it
+
+    Per endpoint (explore, multiline, relatedsearches): a latency histogram, request/retry counts,
+    outcomes and bytes received; per proxy: counts of each status code ('network' for connection
+    errors); per stage (the parsing steps, charts, Excel): count and total time. summary() returns all of it as a dict for
+    json.dump, and with ``trace_path`` every attempt is also appended to that file as a JSON line.
+    """
+
+    # upper bounds (s) of the latency histogram buckets, the last one catches everything slower
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float('inf'))
+
+    def __init__(self, trace_path=None):
+        self.lock = threading.Lock()
+        self.endpoints = dict()
+        self.proxies = dict()
+        self.stages = dict()
+        # line buffered, so the trace survives a crash
+        self.trace = open(trace_path, 'a', encoding='utf-8', buffering=1) if trace_path else None
+
+    def request(self, url, proxy, attempt, status_code, outcome, elapsed, size):
+        """Record one attempt of _get_data"""
+        endpoint = url.rsplit('/', 1)[-1]
+        with self.lock:
+            stats = self.endpoints.get(endpoint)
+            if stats is None:
+                stats = self.endpoints[endpoint] = {'requests': 0, 'retries': 0, 'bytes': 0, 'seconds': 0.0,
+                                                    'max': 0.0, 'histogram': [0] * len(self.BUCKETS),
+                                                    'outcomes': dict()}
+            stats['requests'] += 1
+            stats['retries'] += attempt > 0
+            stats['bytes'] += size
+            stats['seconds'] += elapsed
+            stats['max'] = max(stats['max'], elapsed)
+            stats['histogram'][next(k for k, bound in enumerate(self.BUCKETS) if elapsed <= bound)] += 1
+            stats['outcomes'][outcome] = stats['outcomes'].get(outcome, 0) + 1
+            statuses = self.proxies.setdefault(str(proxy), dict())
+            status = str(status_code) if status_code is not None else 'network'
+            statuses[status] = statuses.get(status, 0) + 1
+            if self.trace is not None:
+                self.trace.write(json.dumps({'time': time.time(), 'endpoint': endpoint, 'proxy': proxy,
+                                             'attempt': attempt, 'status': status_code, 'outcome': outcome,
+                                             'seconds': round(elapsed, 6), 'bytes': size}) + '\n')
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        """Time the work done inside the with block as ``stage``"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                stats = self.stages.setdefault(stage, {'count': 0, 'seconds': 0.0})
+                stats['count'] += 1
+                stats['seconds'] += elapsed
+
+    def summary(self, **extra):
+        """Everything recorded so far as a JSON-serializable dict, ``extra`` is added as is"""
+        with self.lock:
+            endpoints = dict()
+            for endpoint, stats in self.endpoints.items():
+                endpoints[endpoint] = dict(stats, outcomes=dict(stats['outcomes']),
+                                           mean=stats['seconds'] / stats['requests'],
+                                           p50=self._percentile(stats['histogram'], 0.5),
+                                           p90=self._percentile(stats['histogram'], 0.9),
+                                           p99=self._percentile(stats['histogram'], 0.99),
+                                           histogram={str(bound): count for bound, count
+                                                      in zip(self.BUCKETS, stats['histogram'])})
+            return dict(extra, endpoints=endpoints,
+                        proxies={proxy: dict(statuses) for proxy, statuses in self.proxies.items()},
+                        stages={stage: dict(stats) for stage, stats in self.stages.items()})
+
+    def _percentile(self, histogram, q):
+        """Upper bound of the bucket holding the ``q`` quantile, None for the open last bucket"""
+        rank = q * sum(histogram)
+        seen = 0
+        for bound, count in zip(self.BUCKETS, histogram):
+            seen += count
+            if count and seen >= rank:
+                return bound if bound != float('inf') else None
+        return None
+
+    def save(self, path, **extra):
+        with open(path, 'w', encoding='utf-8') as fd:
+            json.dump(self.summary(**extra), fd, ensure_ascii=False, indent=2)
+
+    def close(self):
+        if self.trace is not None:
+            self.trace.close()
+            self.trace = None
+
+
+class ResponseStore:
+    """Raw Google responses in SQLite, content-addressed by method, URL and params (without the token)
+
+    mode 'record': every usable response is saved; 'replay': requests are answered from the store only,
+    after ``latency`` seconds (+-50% jitter) and with ``error_rate`` of them failing with a 429, so the
+    whole pipeline runs offline; 'cache': stored responses younger than ``ttl`` seconds are served and
+    the others are requested and saved, e.g. for 5-year windows that barely change within a day.
+    GtrendReq never serves explore responses in 'cache' mode, their widget tokens expire within the ttl.
+    """
+
+    MODES = ('record', 'replay', 'cache')
+
+    def __init__(self, path, mode='cache', ttl=None, latency=0.0, error_rate=0.0):
+        if mode not in self.MODES:
+            raise ValueError('mode must be one of ' + ', '.join(self.MODES))
+        self.path = path
+        self.mode = mode
+        self.ttl = ttl
+        self.latency = latency
+        self.error_rate = error_rate
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, url TEXT, params TEXT,
+                             status INTEGER, content_type TEXT, body BLOB, saved REAL)""")
+
+    @staticmethod
+    def key(method, url, params):
+        # widget tokens change with every explore, the request itself is identified by the rest
+        params = '&'.join(param for param in params.split('&') if not param.startswith('token='))
+        return hashlib.sha256('{} {}?{}'.format(method.upper(), url, params).encode('utf-8')).hexdigest()
+
+    def get(self, method, url, params):
+        """(status_code, content_type, text) to answer the request with, None to send it to Google"""
+        if self.mode == 'record':
+            return None
+        if self.mode == 'replay' and self.error_rate and random.random() < self.error_rate:
+            return 429, 'text/html', 'Too Many Requests (injected by ResponseStore)'
+        with self.lock:
+            row = self.conn.execute('SELECT status, content_type, body, saved FROM responses WHERE key = ?',
+                                    (self.key(method, url, params),)).fetchone()
+            fresh = row is not None and (self.mode == 'replay' or not self.ttl or row[3] > time.time() - self.ttl)
+            if fresh:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if fresh:
+            return row[0], row[1], zlib.decompress(row[2]).decode('utf-8')
+        if self.mode == 'replay':
+            return 404, 'text/html', 'Not recorded: {}?{}'.format(url, params)
+        return None
+
+    def delay(self):
+        """Simulated latency of the next replayed response"""
+        if self.mode != 'replay' or not self.latency:
+            return 0.0
+        return self.latency * random.uniform(0.5, 1.5)
+
+    def put(self, method, url, params, status_code, content_type, text):
+        if self.mode == 'replay':
+            return
+        with self.lock, self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)', (
+                self.key(method, url, params), url, params, status_code, content_type,
+                zlib.compress(text.encode('utf-8')), time.time()))
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class TrendStore:
+    """Interest-over-time history per keyword, geo and resolution in SQLite, refreshed with short windows
+
+    Google normalizes every request window to 0-100 on its own peak, so a new window is rescaled onto
+    the stored history by the ratio of their sums over the complete points both cover, then replaces the
+    history from its first date on. Values keep the scale of the first fetch and are renormalized to
+    0-100 by trend(). Long daily histories can be built the same way from several overlapping windows.
+    """
+
+    # widest window (days) Google answers at each resolution, wider windows come back coarser
+    MAX_DAYS = {'day': 269, 'week': 1890}
+    # narrowest window requested at each resolution: a week point needs a window wider than MAX_DAYS['day']
+    MIN_DAYS = {'day': 30, 'week': 270}
+    STEP_DAYS = {'day': 1, 'week': 7}
+
+    def __init__(self, path, overlap=8):
+        self.path = path
+        self.overlap = overlap  # complete points a refresh window shares with the history
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS trends (keyword TEXT, geo TEXT, resolution TEXT, date INTEGER,
+                             value REAL, partial INTEGER, PRIMARY KEY (keyword, geo, resolution, date)) WITHOUT ROWID""")
+
+    @staticmethod
+    def span_days(timeframe):
+        """Days covered by a timeframe ('today 5-y', 'today 3-m', 'YYYY-MM-DD YYYY-MM-DD'), None if unknown"""
+        parts = timeframe.split()
+        try:
+            if parts[0] == 'today':
+                count, unit = parts[1].split('-')
+                return int(count) * {'y': 365, 'm': 30, 'd': 1}[unit]
+            return (pd.Timestamp(parts[1]) - pd.Timestamp(parts[0])).days
+        except (IndexError, KeyError, ValueError):
+            return None
+
+    @classmethod
+    def resolution(cls, timeframe):
+        """'day' or 'week', the resolution Google answers ``timeframe`` with; None for hourly or monthly data"""
+        days = cls.span_days(timeframe)
+        if days is None or (timeframe.startswith('today') and days <= 7):
+            return None
+        for resolution in ('day', 'week'):
+            if days <= cls.MAX_DAYS[resolution]:
+                return resolution
+        return None
+
+    @classmethod
+    def _resolution_of(cls, index):
+        if len(index) < 2:
+            return None
+        step = int(np.median(np.diff(index.values).astype('timedelta64[D]').astype('int64')))
+        return {days: resolution for resolution, days in cls.STEP_DAYS.items()}.get(step)
+
+    def history(self, keyword, geo='', resolution='week'):
+        """Stored points as a DataFrame indexed by date with columns ``keyword`` and isPartial, on the stored scale"""
+        with self.lock:
+            rows = self.conn.execute('SELECT date, value, partial FROM trends WHERE keyword = ? AND geo = ? AND '
+                                     'resolution = ? ORDER BY date', (keyword, geo, resolution)).fetchall()
+        dates, values, partial = zip(*rows) if rows else ((), (), ())
+        index = pd.DatetimeIndex(pd.to_datetime(np.array(dates, dtype='int64'), unit='s'), name='date')
+        return pd.DataFrame({keyword: np.array(values, dtype='float64'),
+                             'isPartial': np.array(partial, dtype=bool)}, index=index)
+
+    def window(self, keyword, geo='', resolution='week', today=None):
+        """Timeframe of the short window that brings the history up to ``today``, None when a full fetch is needed"""
+        with self.lock:
+            last = self.conn.execute('SELECT MAX(date) FROM trends WHERE keyword = ? AND geo = ? AND resolution = ? '
+                                     'AND partial = 0', (keyword, geo, resolution)).fetchone()[0]
+        if last is None:
+            return None
+        today = pd.Timestamp.now().normalize() if today is None else pd.Timestamp(today)
+        step = self.STEP_DAYS[resolution]
+        # start on a stored point so that the window's first week is not a partial one
+        points = max(self.overlap - 1, -(-(self.MIN_DAYS[resolution] - (today - pd.Timestamp(last, unit='s')).days) // step))
+        start = pd.Timestamp(last, unit='s') - pd.Timedelta(days=points * step)
+        if (today - start).days > self.MAX_DAYS[resolution]:
+            return None
+        return '{:%Y-%m-%d} {:%Y-%m-%d}'.format(start, today)
+
+    def save(self, keyword, geo, df):
+        """Replace the history with ``df`` (an interest_over_time frame); False if its resolution is not stored"""
+        resolution = self._resolution_of(df.index)
+        if resolution is None:
+            return False
+        with self.lock, self.conn:
+            self.conn.execute('DELETE FROM trends WHERE keyword = ? AND geo = ? AND resolution = ?',
+                              (keyword, geo, resolution))
+            self._insert(keyword, geo, resolution, df[keyword], df['isPartial'])
+        return True
+
+    def extend(self, keyword, geo, df):
+        """Stitch the window ``df`` onto the history; False if they share no complete non-zero points"""
+        resolution = self._resolution_of(df.index)
+        if resolution is None:
+            return False
+        history = self.history(keyword, geo, resolution)
+        complete = history[~history['isPartial']]
+        common = complete.index.intersection(df.index[~df['isPartial'].values])
+        base = complete.loc[common, keyword].sum()
+        part = df.loc[common, keyword].sum()
+        if base == 0 or part == 0:
+            return False
+        with self.lock, self.conn:
+            self.conn.execute('DELETE FROM trends WHERE keyword = ? AND geo = ? AND resolution = ? AND date >= ?',
+                              (keyword, geo, resolution, int(df.index[0].timestamp())))
+            self._insert(keyword, geo, resolution, df[keyword] * (base / part), df['isPartial'])
+        return True
+
+    def _insert(self, keyword, geo, resolution, values, partial):
+        dates = values.index.values.astype('datetime64[s]').astype('int64')
+        self.conn.executemany('INSERT OR REPLACE INTO trends VALUES (?, ?, ?, ?, ?, ?)', zip(
+            itertools.repeat(keyword), itertools.repeat(geo), itertools.repeat(resolution), dates.tolist(),
+            values.values.astype('float64').tolist(), partial.values.astype('int64').tolist()))
+
+    def trend(self, keyword, geo='', resolution='week', start=None):
+        """History from ``start`` on, renormalized to 0-100 like a single interest_over_time response"""
+        df = self.history(keyword, geo, resolution)
+        if start is not None:
+            df = df[df.index >= pd.Timestamp(start)]
+        peak = df[keyword].max() if len(df) else 0
+        if peak > 0:
+            df[keyword] = np.rint(df[keyword] / peak * 100)
+        df[keyword] = df[keyword].astype('int64')
+        return df
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+@dataclasses.dataclass
+class ExploreResult:
+    """Widget data of one explore payload, as returned by GtrendReq.fetch_all()
+
+    related_topics / related_queries map each keyword to {'rising': DataFrame, 'top': DataFrame}
+    (related topics as (columns, rows) records with fetch_all(records=True));
+    failed lists the (widget, keyword) requests that got no usable response, keyword None for the
+    payload-wide interest_over_time and interest_by_region.
+    """
+    keywords: list
+    interest_over_time: 'pd.DataFrame' = None
+    interest_by_region: 'pd.DataFrame' = None
+    related_topics: dict = dataclasses.field(default_factory=dict)
+    related_queries: dict = dataclasses.field(default_factory=dict)
+    failed: list = dataclasses.field(default_factory=list)
+
+    def complete(self, widget):
+        """Whether every request of ``widget`` succeeded"""
+        return all(name != widget for name, _ in self.failed)
 
 
 class GtrendReq:
@@ -18,17 +635,51 @@ class GtrendReq:
     GENERAL_URL = 'https://trends.google.com/trends/api/explore'
     INTEREST_OVER_TIME_URL = 'https://trends.google.com/trends/api/widgetdata/multiline'
     RELATED_QUERIES_URL = 'https://trends.google.com/trends/api/widgetdata/relatedsearches'
+    INTEREST_BY_REGION_URL = 'https://trends.google.com/trends/api/widgetdata/comparedgeo'
+    # widgets fetch_all() can request, also the fields of ExploreResult
+    FETCH_WIDGETS = ('interest_over_time', 'interest_by_region', 'related_topics', 'related_queries')
 
-    def __init__(self, hl='en-US', tz=360, geo='US', retries=1):
-        self.headers = dict()
+    def __init__(self, hl='en-US', tz=360, geo='US', retries=1, proxy=None, limiter=None, headers=None,
+                 pool_connections=10, pool_maxsize=10, token_cache=None, pool=None, retry_policy=None, metrics=None,
+                 verbosity=1, response_store=None):
+        self.headers = dict(headers or {})
         self.hl = hl
         self.tz = tz
         self.geo = geo
         self.retries = max(retries, 1)
+        # proxy used by the next request (None: fall back to the https_proxy environment variable)
+        self.proxy = proxy
+        # optional TokenBucket shared by every client that uses the same proxy
+        self.limiter = limiter
+        # optional ProxyPool, when set every request picks its proxy (and limiter) from the pool instead
+        self.pool = pool
+        # failure classification, backoff and timeouts of _get_data
+        self.retry_policy = retry_policy or RetryPolicy()
+        # monotonic time after which _get_data stops retrying, see start_deadline()
+        self.deadline_at = None
+        # optional Metrics shared by every client
+        self.metrics = metrics
+        # request diagnostics printed by _get_data: 0 none, 1 one line per attempt, 2 also the response bodies
+        self.verbosity = verbosity
+        # optional ResponseStore recording, replaying or caching the raw responses
+        self.response_store = response_store
+        # optional TokenCache shared by every client
+        self.token_cache = token_cache
+        # whether the current widgets came from token_cache
+        self.cached_tokens = False
+        # status code of the last response
+        self.status_code = None
+        # keep-alive sessions, one per proxy endpoint
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self._sessions = dict()
+        self._sessions_lock = threading.Lock()
         self.kw_list = list()
         self.prepare_post_url = str()
         self.prepare_gettrend_url = str()
         self.prepare_getrelatedtopic_url = str()
+        # keyword -> related topics query string of the last related_topics() call
+        self.prepare_getrelatedtopic_urls = dict()
         # intialize widget payloads
         self.token_payload = dict()
         self.interest_over_time_widget = dict()
@@ -36,6 +687,36 @@ class GtrendReq:
         self.related_topics_widget_list = list()
         self.related_queries_widget_list = list()
 
+    def _session(self, proxy):
+        """Return the pooled session for ``proxy``, creating it on first use
+
+        Headers (user-agent, cookie, ...) and the proxy are set once on the session, so they
+        are not rebuilt for every request and nothing depends on os.environ.
+        """
+        with self._sessions_lock:
+            session = self._sessions.get(proxy)
+            if session is None:
+                session = requests.Session()
+                # DO NOT USE retries or backoff_factor here, _get_data retries on its own
+                adapter = HTTPAdapter(pool_connections=self.pool_connections, pool_maxsize=self.pool_maxsize,
+                                      max_retries=0)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                session.headers.update(self.headers)
+                if proxy:
+                    # environment proxies would otherwise take precedence over session.proxies
+                    session.trust_env = False
+                    session.proxies = {'http': proxy, 'https': proxy}
+                self._sessions[proxy] = session
+            return session
+
+    def close(self):
+        """Close every pooled session"""
+        with self._sessions_lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions.clear()
+
     def _get_data(self, url, params, method=GET_METHOD, trim_chars=0):
         """Send a request to Google and return the JSON response as a Python object
         :param url: the url to which the request will be sent
@@ -46,54 +727,151 @@ class GtrendReq:
         :return:
         """
         # Retries mechanism. Activated when one of statements >0 (best used for proxy)
-        i = 0
-        while i < self.retries + 1:
-            print("#=============================================================================\n")
-            print("第{}次请求:".format(i + 1))
-            if method == GtrendReq.POST_METHOD:
-                response = requests.post(url, params=params, headers=self.headers,
-                                         timeout=(50, 60))  # DO NOT USE retries or backoff_factor here
-                print(response.url)
-                print(response.status_code)
-                print(response.text)
-            else:
-                response = requests.get(url, params=params,
-                                        timeout=(50, 60))  # DO NOT USE retries or backoff_factor here
-                print(response.url)
-                print(response.status_code)
-                print(response.text)
-            if response.status_code == 200 or response.status_code == 400:
-                print("\n#=============================================================================")
+        policy = self.retry_policy
+        tried = list()
+        status_code = None
+        self.status_code = None
+        for attempt in range(self.retries + 1):
+            remaining = self._remaining()
+            if remaining is not None and remaining <= 0:
+                self._log(1, "已超过主题的请求期限({}秒), 不再请求".format(policy.deadline))
                 break
+            self._log(1, "#=============================================================================\n")
+            self._log(1, "第{}次请求:".format(attempt + 1))
+            stored = self._stored(method, url, params)
+            if stored is not None:
+                time.sleep(self.response_store.delay())
+                status_code, content_type, text = stored
+                outcome = self._record_stored(url, attempt, status_code, content_type, text)
+                retry_after = None
             else:
-                time.sleep(random.uniform(3, 5))
-                i += 1
+                proxy, limiter = self._next_proxy(tried)
+                tried.append(proxy)
+                if limiter is not None:
+                    limiter.acquire()
+                session = self._session(proxy)
+                start = time.monotonic()
+                try:
+                    response = session.request(method.upper(), url, params=params, timeout=policy.timeout(remaining))
+                    status_code = response.status_code
+                    content_type = response.headers.get('Content-Type', '')
+                    text = response.text
+                    outcome = policy.classify(status_code, content_type, text)
+                    retry_after = response.headers.get('Retry-After')
+                    size = len(response.content)
+                    self._log(1, response.url)
+                    self._log(1, "{} {}, {}字节".format(status_code, outcome, size))
+                    self._log(2, text)
+                except requests.exceptions.RequestException as e:
+                    outcome = policy.classify(error=e)
+                    self._log(1, "请求异常({}): {}".format(outcome, e))
+                    status_code = retry_after = content_type = text = None
+                    size = 0
+                self._record(url, proxy, attempt, status_code, outcome, time.monotonic() - start, size)
+                self._store(method, url, params, status_code, content_type, text, outcome)
+            self.status_code = status_code
+            delay = self._retry_delay(attempt, outcome, retry_after)
+            if delay is None:
+                break
+            time.sleep(delay)
+        self._log(1, "\n#=============================================================================")
+        if status_code is None:
+            return None
+        with self._timing('json'):
+            return self._parse_response(status_code, content_type, text, trim_chars)
+
+    def _next_proxy(self, tried):
+        """Proxy and limiter of the next attempt: from the pool (avoiding the ``tried`` proxies) or the fixed ones"""
+        if self.pool is None:
+            return self.proxy, self.limiter
+        proxy = self.pool.choose(exclude=tried)
+        self._log(1, "代理: {}".format(proxy))
+        return proxy, self.pool.limiter(proxy)
+
+    def _record(self, url, proxy, attempt, status_code, outcome, elapsed, size):
+        """Report an attempt to the proxy pool and the metrics"""
+        if self.pool is not None:
+            self.pool.record(proxy, outcome, elapsed)
+        if self.metrics is not None:
+            self.metrics.request(url, proxy, attempt, status_code, outcome, elapsed, size)
+
+    def _stored(self, method, url, params):
+        """Response served by response_store instead of Google, None to send the request"""
+        if self.response_store is None:
+            return None
+        if self.response_store.mode == 'cache' and url == self.GENERAL_URL:
+            # widget tokens expire long before the ttl, a stale explore would fail every widget request that
+            # was not stored on the previous run; tokens are left to token_cache
+            return None
+        return self.response_store.get(method, url, params)
+
+    def _record_stored(self, url, attempt, status_code, content_type, text):
+        """Classify and log a response served by response_store, the proxy pool does not see it"""
+        outcome = self.retry_policy.classify(status_code, content_type, text)
+        self._log(1, "{}({}): {} {}, {}字节".format(url, self.response_store.mode, status_code, outcome, len(text)))
+        if self.metrics is not None:
+            self.metrics.request(url, self.response_store.mode, attempt, status_code, outcome, 0.0, len(text))
+        return outcome
+
+    def _store(self, method, url, params, status_code, content_type, text, outcome):
+        if self.response_store is not None and outcome == 'ok':
+            self.response_store.put(method, url, params, status_code, content_type, text)
+
+    def _timing(self, stage):
+        return self.metrics.timer(stage) if self.metrics is not None else contextlib.nullcontext()
+
+    def _log(self, level, message):
+        """Print request diagnostics: level 1 one line per attempt, level 2 also the response bodies"""
+        if self.verbosity >= level:
+            print(message)
+
+    def _retry_delay(self, attempt, outcome, retry_after):
+        """Seconds to wait before the next attempt, None to stop retrying"""
+        if outcome not in RetryPolicy.RETRYABLE or attempt >= self.retries:
+            return None
+        switch = self.pool is not None and len(self.pool.proxies) > 1
+        delay = self.retry_policy.delay(attempt, outcome, retry_after, switch)
+        remaining = self._remaining()
+        if remaining is not None and delay >= remaining:
+            self._log(1, "等待{:.1f}秒会超过主题的请求期限, 不再重试".format(delay))
+            return None
+        if delay:
+            self._log(1, "{:.1f}秒后重试".format(delay))
+        return delay
+
+    def start_deadline(self, keywords=1):
+        """Start the request deadline of the next ``keywords`` keywords (RetryPolicy.deadline seconds each)"""
+        deadline = self.retry_policy.deadline
+        self.deadline_at = time.monotonic() + deadline * keywords if deadline else None
+
+    def _remaining(self):
+        """Seconds left before the deadline, None without one"""
+        if self.deadline_at is None:
+            return None
+        return self.deadline_at - time.monotonic()
+
+    def _parse_response(self, status_code, content_type, text, trim_chars):
+        """Decode the body of the last response of _get_data, None if it is not usable JSON"""
         # check if the response contains json and throw an exception otherwise
-        # Google mostly sends 'application/json' in the Content-Type header,
-        # but occasionally it sends 'application/javascript
-        # and sometimes even 'text/javascript
-        if response.status_code == 200 and 'application/json' in \
-                response.headers['Content-Type'] or \
-                'application/javascript' in response.headers['Content-Type'] or \
-                'text/javascript' in response.headers['Content-Type']:
+        if status_code == 200 and any(json_type in content_type for json_type in RetryPolicy.JSON_TYPES):
             # trim initial characters
             # some responses start with garbage characters, like ")]}',"
             # these have to be cleaned before being passed to the json parser
-            content = response.text[trim_chars:]
+            content = text[trim_chars:]
             # parse json
             return json.loads(content)
         else:
             # error
-            try:
-                response.raise_for_status()
-            except:
-                print('The request failed: Google returned a '
-                      'response with code {0}.'.format(response.status_code))
-                print("\n#=============================================================================")
-                return None
+            self._log(1, 'The request failed: Google returned a '
+                         'response with code {0}.'.format(status_code))
+            return None
 
     def build_payload(self, kw_list, cat=0, timeframe='today 5-y', geo='', gprop=''):
         """Create the payload for related queries, interest over time and interest by region"""
+        self._build_token_payload(kw_list, cat, timeframe, geo, gprop)
+        return self._tokens()
+
+    def _build_token_payload(self, kw_list, cat, timeframe, geo, gprop):
         if gprop not in ['', 'images', 'news', 'youtube', 'froogle']:
             raise ValueError('gprop must be empty (to indicate web), images, news, youtube, or froogle')
         self.kw_list = kw_list
@@ -111,7 +889,6 @@ class GtrendReq:
         # requests will mangle this if it is not a string
         self.token_payload['req'] = json.dumps(self.token_payload['req'], separators=(',', ':'))
         self.prepare_post_url = urlencode(self.token_payload, safe=":,")
-        return self._tokens()
 
     def _tokens(self):
         """Makes request to Google to get API tokens for interest over time, interest by region and related queries"""
@@ -119,8 +896,10 @@ class GtrendReq:
         # r = requests.post(self.GENERAL_URL, params=self.prepare_post_url, headers=self.headers)
         # print(r.text)
         # resultjson = json.loads(r.text[4:])
+        if self._cached_widgets():
+            return True
         widget_dicts = self._get_data(
-            GtrendReq.GENERAL_URL,
+            self.GENERAL_URL,
             self.prepare_post_url,
             method=GtrendReq.POST_METHOD,
             trim_chars=4,
@@ -129,14 +908,37 @@ class GtrendReq:
 
         if widget_dicts is None:
             return False
+        self._store_widgets(widget_dicts['widgets'])
+        return True
+
+    def _cached_widgets(self):
+        """Take the widgets of the current payload from token_cache, True on a hit"""
+        widget_dicts = self.token_cache.get(self.prepare_post_url) if self.token_cache is not None else None
+        self.cached_tokens = widget_dicts is not None
+        if self.cached_tokens:
+            self._set_widgets(widget_dicts)
+        return self.cached_tokens
 
-        widget_dicts = widget_dicts['widgets']
+    def _store_widgets(self, widget_dicts):
+        self._set_widgets(widget_dicts)
+        if self.token_cache is not None:
+            self.token_cache.set(self.prepare_post_url, widget_dicts)
+
+    def _token_expired(self):
+        """Whether a failed widget request was caused by an expired token from token_cache"""
+        if self.cached_tokens and self.status_code in (400, 401):
+            self._log(1, "缓存的token已过期, 重新获取")
+            self.token_cache.invalidate(self.prepare_post_url)
+            return True
+        return False
+
+    def _set_widgets(self, widget_dicts):
         # order of the json matters...
         first_region_token = True
-        # clear self.related_queries_widget_list and self.related_topics_widget_list
-        # of old keywords'widgets
-        self.related_queries_widget_list[:] = []
-        self.related_topics_widget_list[:] = []
+        # drop the old keywords' widgets; new lists rather than clearing in place, shallow copies made by
+        # refresh_trend and fetch_all must not change the widgets of the client they were copied from
+        self.related_queries_widget_list = list()
+        self.related_topics_widget_list = list()
         # assign requests
         for widget in widget_dicts:
             # print(widget['request'])
@@ -153,332 +955,1506 @@ class GtrendReq:
                 self.related_topics_widget_list.append(widget)
             if 'RELATED_QUERIES' in widget['id']:
                 self.related_queries_widget_list.append(widget)
-        return True
 
-    def interest_over_time(self):
-        """Request data from Google's Interest Over Time section and return a dataframe"""
-
-        over_time_payload = {
+    def _widget_params(self, widget):
+        """Query string for a widget data request"""
+        payload = {
             # convert to string as requests will mangle
             'hl': self.hl,
             'tz': self.tz,
-            'req': json.dumps(self.interest_over_time_widget['request'], separators=(',', ':')),
-            'token': self.interest_over_time_widget['token'],
-            # 'tz': self.tz
+            'req': json.dumps(widget['request'], separators=(',', ':')),
+            'token': widget['token'],
         }
-        # print(over_time_payload['req'])
+        return urlencode(payload, safe=":,")
+
+    def interest_over_time(self):
+        """Request data from Google's Interest Over Time section and return a dataframe"""
         # make the request and parse the returned json
-        self.prepare_gettrend_url = urlencode(over_time_payload, safe=":,")
+        self.prepare_gettrend_url = self._widget_params(self.interest_over_time_widget)
         # r = requests.get(self.INTEREST_OVER_TIME_URL, params=self.prepare_gettrend_url)
 
         # print(r.url)
         # print(r.text)
         # req_json = json.loads(r.text[5:])
         req_json = self._get_data(
-            url=GtrendReq.INTEREST_OVER_TIME_URL,
+            url=self.INTEREST_OVER_TIME_URL,
             params=self.prepare_gettrend_url,
             method=GtrendReq.GET_METHOD,
             trim_chars=5,
         )
 
         if req_json is None:
+            if self._token_expired() and self._tokens():
+                return self.interest_over_time()
             return None
-        df = pd.DataFrame(req_json['default']['timelineData'])
-        if (df.empty):
-            return df
+        with self._timing('interest_over_time'):
+            return self._parse_interest_over_time(req_json)
 
-        df['date'] = pd.to_datetime(df['time'].astype(dtype='float64'),
-                                    unit='s')
-        df = df.set_index(['date']).sort_index()
-        # split list columns into seperate ones, remove brackets and split on comma
-        result_df = df['value'].apply(lambda x: pd.Series(
-            str(x).replace('[', '').replace(']', '').split(',')))
-        # rename each column with its search term, relying on order that google provides...
-        for idx, kw in enumerate(self.kw_list):
-            # there is currently a bug with assigning columns that may be
-            # parsed as a date in pandas: use explicit insert column method
-            result_df.insert(len(result_df.columns), kw,
-                             result_df[idx].astype('int'))
-            del result_df[idx]
-
-        if 'isPartial' in df:
-            # make other dataframe from isPartial key data
-            # split list columns into seperate ones, remove brackets and split on comma
-            df = df.fillna(False)
-            result_df2 = df['isPartial'].apply(lambda x: pd.Series(
-                str(x).replace('[', '').replace(']', '').split(',')))
-            result_df2.columns = ['isPartial']
-            # Change to a bool type.
-            result_df2.isPartial = result_df2.isPartial == 'True'
-            # concatenate the two dataframes
-            final = pd.concat([result_df, result_df2], axis=1)
-        else:
-            final = result_df
-            final['isPartial'] = False
+    def _parse_interest_over_time(self, req_json):
+        timeline = req_json['default']['timelineData']
+        if not timeline:
+            return pd.DataFrame(timeline)
+
+        # one pass over timelineData straight into numpy arrays, no per-row Series or string round trips
+        n = len(timeline)
+        width = len(timeline[0]['value'])
+        values = np.fromiter(itertools.chain.from_iterable(point['value'] for point in timeline),
+                             dtype='int64', count=n * width).reshape(n, width)
+        times = np.fromiter((point['time'] for point in timeline), dtype='float64', count=n)
+        is_partial = np.fromiter((point.get('isPartial') is True for point in timeline), dtype=bool, count=n)
+
+        order = np.argsort(times, kind='stable')
+        index = pd.DatetimeIndex(pd.to_datetime(times[order], unit='s'), name='date')
+        # name each column with its search term, relying on order that google provides...
+        final = pd.DataFrame({kw: values[order, idx] for idx, kw in enumerate(self.kw_list)}, index=index)
+        final['isPartial'] = is_partial[order]
+        return final
+
+    def interest_by_region(self, resolution='COUNTRY', inc_low_vol=False, inc_geo_code=False):
+        """Request data from Google's Interest by Region section and return a dataframe indexed by geoName"""
+        result = self.fetch_all(widgets=('interest_by_region',), resolution=resolution, inc_low_vol=inc_low_vol,
+                                inc_geo_code=inc_geo_code)
+        return result.interest_by_region
+
+    def _interest_by_region_params(self, resolution, inc_low_vol):
+        request = dict(self.interest_by_region_widget['request'])
+        if self.geo == '' or (self.geo == 'US' and resolution in ('DMA', 'CITY', 'REGION')):
+            request['resolution'] = resolution
+        request['includeLowSearchVolumeGeos'] = inc_low_vol
+        return self._widget_params({'request': request, 'token': self.interest_by_region_widget['token']})
 
+    def _parse_interest_by_region(self, req_json, inc_geo_code=False):
+        geo_data = req_json['default']['geoMapData']
+        if not geo_data:
+            return pd.DataFrame(geo_data)
+
+        n = len(geo_data)
+        width = len(geo_data[0]['value'])
+        values = np.fromiter(itertools.chain.from_iterable(point['value'] for point in geo_data),
+                             dtype='int64', count=n * width).reshape(n, width)
+        names = np.array([point['geoName'] for point in geo_data], dtype=object)
+        order = np.argsort(names, kind='stable')
+        final = pd.DataFrame(index=pd.Index(names[order], name='geoName'))
+        if inc_geo_code:
+            geo_column = 'geoCode' if 'geoCode' in geo_data[0] else 'coordinates'
+            final[geo_column] = [geo_data[idx].get(geo_column) for idx in order]
+        # name each column with its search term, relying on order that google provides...
+        for idx, kw in enumerate(self.kw_list):
+            final[kw] = values[order, idx]
         return final
 
-    def related_topics(self):
+    def related_topics(self, keywords=None, records=False):
         """Request data from Google's Related Topics section and return a dictionary of dataframes
 
         If no top and/or rising related topics are found, the value for the key "top" and/or "rising" will be None
+        :param keywords: only request the widgets of these keywords (default: every keyword of the payload)
+        :param records: (columns, rows) tuples instead of dataframes, see _related_topic_records()
         """
+        result = self.fetch_all(keywords, widgets=('related_topics',), records=records)
+        return result.related_topics if result.complete('related_topics') else None
 
-        # make the request
-        related_payload = dict()
-        result_dict = dict()
-        for request_json in self.related_topics_widget_list:
-            # ensure we know which keyword we are looking at rather than relying on order
-            try:
-                kw = request_json['request']['restriction'][
-                    'complexKeywordsRestriction']['keyword'][0]['value']
-            except KeyError:
-                kw = ''
-            related_payload['hl'] = self.hl
-            related_payload['tz'] = self.tz
-            # convert to string as requests will mangle
-            related_payload['req'] = json.dumps(request_json['request'], separators=(',', ':'))
-            related_payload['token'] = request_json['token']
-
-            self.prepare_getrelatedtopic_url = urlencode(related_payload, safe=":,")
-            # print("self.prepare_getrelatedtopic_url:\n")
-            # print(self.prepare_getrelatedtopic_url)
-            # parse the returned json
-            req_json = self._get_data(
-                url=GtrendReq.RELATED_QUERIES_URL,
-                method=GtrendReq.GET_METHOD,
-                trim_chars=5,
-                params=self.prepare_getrelatedtopic_url,
-            )
-            # print(req_json)
+    def related_queries(self, keywords=None):
+        """Request data from Google's Related Queries section and return a dictionary of dataframes
+
+        Same layout as related_topics(): {keyword: {'rising': DataFrame or None, 'top': DataFrame or None}}
+        """
+        result = self.fetch_all(keywords, widgets=('related_queries',))
+        return result.related_queries if result.complete('related_queries') else None
+
+    def fetch_all(self, keywords=None, widgets=FETCH_WIDGETS, resolution='COUNTRY', inc_low_vol=False,
+                  inc_geo_code=False, records=False):
+        """Request every widget of the current payload at the same time and return an ExploreResult
+
+        :param keywords: only request the related topics/queries widgets of these keywords
+        :param widgets: which of FETCH_WIDGETS to request
+        :param records: related topics as (columns, rows) tuples instead of dataframes
+        The wall time is that of the slowest widget instead of the sum of all of them.
+        """
+        jobs = self._widget_jobs(keywords, widgets, resolution, inc_low_vol, inc_geo_code, records)
+        if len(jobs) == 1:
+            responses = [self._fetch_widget(jobs[0][2], jobs[0][3])]
+        elif jobs:
+            with ThreadPoolExecutor(max_workers=len(jobs)) as executor:
+                responses = list(executor.map(lambda job: self._fetch_widget(job[2], job[3]), jobs))
+        else:
+            responses = list()
+        if self._widget_tokens_expired(responses) and self._tokens():
+            return self.fetch_all(keywords, widgets, resolution, inc_low_vol, inc_geo_code, records)
+        return self._explore_result(jobs, responses)
+
+    def _fetch_widget(self, url, params):
+        """(json, status code) of one widget request, made on a shallow copy so concurrent requests
+        share the sessions, pool and metrics but not status_code"""
+        worker = copy.copy(self)
+        req_json = worker._get_data(url=url, params=params, method=GtrendReq.GET_METHOD, trim_chars=5)
+        return req_json, worker.status_code
+
+    def _widget_jobs(self, keywords, widgets, resolution, inc_low_vol, inc_geo_code, records=False):
+        """(widget, keyword, url, params, parser) of every request fetch_all() makes"""
+        jobs = list()
+        if 'interest_over_time' in widgets and self.interest_over_time_widget:
+            self.prepare_gettrend_url = self._widget_params(self.interest_over_time_widget)
+            jobs.append(('interest_over_time', None, self.INTEREST_OVER_TIME_URL, self.prepare_gettrend_url,
+                         self._parse_interest_over_time))
+        if 'interest_by_region' in widgets and self.interest_by_region_widget:
+            jobs.append(('interest_by_region', None, self.INTEREST_BY_REGION_URL,
+                         self._interest_by_region_params(resolution, inc_low_vol),
+                         functools.partial(self._parse_interest_by_region, inc_geo_code=inc_geo_code)))
+        if 'related_topics' in widgets:
+            topic_widgets = self._related_topics_widgets(keywords)
+            self.prepare_getrelatedtopic_urls = {self._widget_keyword(widget): self._widget_params(widget)
+                                                 for widget in topic_widgets}
+            if topic_widgets:
+                self.prepare_getrelatedtopic_url = self._widget_params(topic_widgets[-1])
+            jobs.extend(('related_topics', self._widget_keyword(widget), self.RELATED_QUERIES_URL,
+                         self._widget_params(widget),
+                         self._related_topic_records if records else self._parse_related_topics)
+                        for widget in topic_widgets)
+        if 'related_queries' in widgets:
+            jobs.extend(('related_queries', self._widget_keyword(widget), self.RELATED_QUERIES_URL,
+                         self._widget_params(widget), self._parse_related_queries)
+                        for widget in self._related_queries_widgets(keywords))
+        return jobs
+
+    def _widget_tokens_expired(self, responses):
+        """Whether a failed fetch_all() request was caused by an expired token from token_cache"""
+        failed = [status_code for req_json, status_code in responses if req_json is None]
+        if not failed:
+            return False
+        self.status_code = next((status_code for status_code in failed if status_code in (400, 401)), failed[0])
+        return self._token_expired()
+
+    def _explore_result(self, jobs, responses):
+        result = ExploreResult(keywords=list(self.kw_list))
+        for (widget, kw, _, _, parse), (req_json, _) in zip(jobs, responses):
             if req_json is None:
-                return None
-            # top topics
-            try:
-                top_list = req_json['default']['rankedList'][0][
-                    'rankedKeyword']
-                df_top = pd.DataFrame(
-                    [nested_to_record(d, sep='_') for d in top_list])
-            except KeyError:
-                # in case no top topics are found, the lines above will throw a KeyError
-                df_top = None
+                result.failed.append((widget, kw))
+                continue
+            with self._timing(widget):
+                value = parse(req_json)
+            if kw is None:
+                setattr(result, widget, value)
+            else:
+                getattr(result, widget)[kw] = value
+        return result
+
+    def _widget_keyword(self, widget):
+        # ensure we know which keyword we are looking at rather than relying on order
+        try:
+            return widget['request']['restriction']['complexKeywordsRestriction']['keyword'][0]['value']
+        except KeyError:
+            return self.kw_list[0] if len(self.kw_list) == 1 else ''
+
+    def _related_topics_widgets(self, keywords):
+        return [widget for widget in self.related_topics_widget_list
+                if keywords is None or self._widget_keyword(widget) in keywords]
 
-            # rising topics
+    def _related_queries_widgets(self, keywords):
+        return [widget for widget in self.related_queries_widget_list
+                if keywords is None or self._widget_keyword(widget) in keywords]
+
+    @staticmethod
+    def _parse_related_topics(req_json):
+        return {kind: None if table is None else pd.DataFrame(table[1], columns=list(table[0]))
+                for kind, table in GtrendReq._related_topic_records(req_json).items()}
+
+    @staticmethod
+    def _related_topic_records(req_json):
+        """{'rising': (columns, rows), 'top': (columns, rows)} of a related topics response without building a
+        DataFrame; the columns are those of the related_topics() dataframes, a field a topic lacks is None"""
+        records = dict()
+        for kind, position in (('rising', 1), ('top', 0)):
             try:
-                rising_list = req_json['default']['rankedList'][1][
-                    'rankedKeyword']
-                df_rising = pd.DataFrame(
-                    [nested_to_record(d, sep='_') for d in rising_list])
+                ranked = [GtrendReq._flatten(d) for d in req_json['default']['rankedList'][position]['rankedKeyword']]
             except KeyError:
-                # in case no rising topics are found, the lines above will throw a KeyError
-                df_rising = None
+                # in case no top/rising topics are found
+                records[kind] = None
+                continue
+            columns = tuple(dict.fromkeys(column for record in ranked for column in record))
+            records[kind] = columns, [tuple(record.get(column) for column in columns) for record in ranked]
+        return records
+
+    @staticmethod
+    def _flatten(record):
+        """Nested dicts as <key>_<field> columns after the plain ones, the columns pandas' nested_to_record gives
+        for a ranked keyword, without its deep copy of every record"""
+        flat = {key: value for key, value in record.items() if not isinstance(value, dict)}
+        for key, value in record.items():
+            if isinstance(value, dict):
+                flat.update(('{}_{}'.format(key, field), item) for field, item in value.items())
+        return flat
+
+    @staticmethod
+    def _parse_related_queries(req_json):
+        # top queries
+        try:
+            top_list = req_json['default']['rankedList'][0]['rankedKeyword']
+            df_top = pd.DataFrame(top_list)[['query', 'value']]
+        except KeyError:
+            # in case no top queries are found, the lines above will throw a KeyError
+            df_top = None
+
+        # rising queries
+        try:
+            rising_list = req_json['default']['rankedList'][1]['rankedKeyword']
+            df_rising = pd.DataFrame(rising_list)[['query', 'value']]
+        except KeyError:
+            # in case no rising queries are found, the lines above will throw a KeyError
+            df_rising = None
+
+        return {'rising': df_rising, 'top': df_top}
+
+
+class AsyncGtrendReq(GtrendReq):
+    """asyncio version of GtrendReq on top of an aiohttp session
+
+    build_payload, interest_over_time and related_topics are coroutines; the retry backoff
+    sleeps with asyncio.sleep so other keywords keep moving while one request backs off.
+    An instance holds the widgets of one payload, use fork() to run independent payloads
+    (e.g. the 5-year and 7-day explore of a keyword) at the same time over the same session.
+    """
+
+    def __init__(self, *args, session=None, **kwargs):
+        try:
+            _import_aiohttp()
+        except ImportError:
+            raise ImportError('AsyncGtrendReq requires aiohttp (pip install aiohttp)') from None
+        super().__init__(*args, **kwargs)
+        self.session = session
+
+    def fork(self, proxy=None, limiter=None):
+        """New client sharing this client's settings, token cache and aiohttp session but with its own payload state"""
+        if self.session is None:
+            self._async_session()
+        clone = AsyncGtrendReq(hl=self.hl, tz=self.tz, geo=self.geo, retries=self.retries,
+                               proxy=proxy or self.proxy, limiter=limiter or self.limiter, headers=self.headers,
+                               pool_connections=self.pool_connections, pool_maxsize=self.pool_maxsize,
+                               token_cache=self.token_cache, pool=self.pool, retry_policy=self.retry_policy,
+                               metrics=self.metrics, verbosity=self.verbosity, response_store=self.response_store,
+                               session=self.session)
+        return clone
+
+    def _async_session(self):
+        if self.session is None:
+            connector = aiohttp.TCPConnector(limit=self.pool_connections * self.pool_maxsize)
+            self.session = aiohttp.ClientSession(headers=self.headers, connector=connector)
+        return self.session
+
+    async def close(self):
+        """Close the shared aiohttp session"""
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def _get_data(self, url, params, method=GtrendReq.GET_METHOD, trim_chars=0):
+        """Coroutine version of GtrendReq._get_data"""
+        session = self._async_session()
+        policy = self.retry_policy
+        tried = list()
+        status_code = None
+        self.status_code = None
+        for attempt in range(self.retries + 1):
+            remaining = self._remaining()
+            if remaining is not None and remaining <= 0:
+                self._log(1, "已超过主题的请求期限({}秒), 不再请求".format(policy.deadline))
+                break
+            self._log(1, "#=============================================================================\n")
+            self._log(1, "第{}次请求:".format(attempt + 1))
+            stored = self._stored(method, url, params)
+            if stored is not None:
+                await asyncio.sleep(self.response_store.delay())
+                status_code, content_type, text = stored
+                outcome = self._record_stored(url, attempt, status_code, content_type, text)
+                retry_after = None
+            else:
+                proxy, limiter = self._next_proxy(tried)
+                tried.append(proxy)
+                if limiter is not None:
+                    await limiter.acquire_async()
+                connect, read = policy.timeout(remaining)
+                timeout = aiohttp.ClientTimeout(total=remaining, sock_connect=connect, sock_read=read)
+                start = time.monotonic()
+                try:
+                    # params is already urlencoded, keep it verbatim in the url
+                    async with session.request(method.upper(), URL(url + '?' + params, encoded=True),
+                                               proxy=proxy, timeout=timeout) as response:
+                        size = len(await response.read())
+                        text = await response.text()
+                        status_code = response.status
+                        content_type = response.headers.get('Content-Type', '')
+                        retry_after = response.headers.get('Retry-After')
+                    outcome = policy.classify(status_code, content_type, text)
+                    self._log(1, response.url)
+                    self._log(1, "{} {}, {}字节".format(status_code, outcome, size))
+                    self._log(2, text)
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    outcome = policy.classify(error=e)
+                    self._log(1, "请求异常({}): {!r}".format(outcome, e))
+                    status_code = retry_after = content_type = text = None
+                    size = 0
+                self._record(url, proxy, attempt, status_code, outcome, time.monotonic() - start, size)
+                self._store(method, url, params, status_code, content_type, text, outcome)
+            self.status_code = status_code
+            delay = self._retry_delay(attempt, outcome, retry_after)
+            if delay is None:
+                break
+            await asyncio.sleep(delay)
+        self._log(1, "\n#=============================================================================")
+        if status_code is None:
+            return None
+        with self._timing('json'):
+            return self._parse_response(status_code, content_type, text, trim_chars)
+
+    async def build_payload(self, kw_list, cat=0, timeframe='today 5-y', geo='', gprop=''):
+        self._build_token_payload(kw_list, cat, timeframe, geo, gprop)
+        return await self._tokens()
+
+    async def _tokens(self):
+        if self._cached_widgets():
+            return True
+        widget_dicts = await self._get_data(
+            self.GENERAL_URL,
+            self.prepare_post_url,
+            method=GtrendReq.POST_METHOD,
+            trim_chars=4,
+        )
+        if widget_dicts is None:
+            return False
+        self._store_widgets(widget_dicts['widgets'])
+        return True
+
+    async def interest_over_time(self):
+        self.prepare_gettrend_url = self._widget_params(self.interest_over_time_widget)
+        req_json = await self._get_data(
+            url=self.INTEREST_OVER_TIME_URL,
+            params=self.prepare_gettrend_url,
+            method=GtrendReq.GET_METHOD,
+            trim_chars=5,
+        )
+        if req_json is None:
+            if self._token_expired() and await self._tokens():
+                return await self.interest_over_time()
+            return None
+        with self._timing('interest_over_time'):
+            return self._parse_interest_over_time(req_json)
+
+    async def interest_by_region(self, resolution='COUNTRY', inc_low_vol=False, inc_geo_code=False):
+        result = await self.fetch_all(widgets=('interest_by_region',), resolution=resolution,
+                                      inc_low_vol=inc_low_vol, inc_geo_code=inc_geo_code)
+        return result.interest_by_region
+
+    async def related_topics(self, keywords=None, records=False):
+        """Request every related topics widget concurrently"""
+        result = await self.fetch_all(keywords, widgets=('related_topics',), records=records)
+        return result.related_topics if result.complete('related_topics') else None
+
+    async def related_queries(self, keywords=None):
+        result = await self.fetch_all(keywords, widgets=('related_queries',))
+        return result.related_queries if result.complete('related_queries') else None
+
+    async def fetch_all(self, keywords=None, widgets=GtrendReq.FETCH_WIDGETS, resolution='COUNTRY',
+                        inc_low_vol=False, inc_geo_code=False, records=False):
+        """Coroutine version of GtrendReq.fetch_all"""
+        # create the session before the per-request copies, otherwise each copy opens its own and never closes it
+        self._async_session()
+        jobs = self._widget_jobs(keywords, widgets, resolution, inc_low_vol, inc_geo_code, records)
+        responses = await asyncio.gather(*[self._fetch_widget(url, params) for _, _, url, params, _ in jobs])
+        if self._widget_tokens_expired(responses) and await self._tokens():
+            return await self.fetch_all(keywords, widgets, resolution, inc_low_vol, inc_geo_code, records)
+        return self._explore_result(jobs, responses)
 
-            result_dict[self.kw_list[0]] = {'rising': df_rising, 'top': df_top}
-        return result_dict
+    async def _fetch_widget(self, url, params):
+        worker = copy.copy(self)
+        req_json = await worker._get_data(url=url, params=params, method=GtrendReq.GET_METHOD, trim_chars=5)
+        return req_json, worker.status_code
 
 
-def gtrendplotly(data, path):
+def gtrendfigure(data):
+    import plotly.graph_objects as go
+
     fig = go.Figure()
     fig.add_trace(go.Scatter(x=data["date"], y=data[data.columns.values[1]], mode="markers+lines", name="5year"))
     fig.add_trace(
         go.Scatter(x=data["date"][-52:], y=data[data.columns.values[1]][-52:], mode="markers+lines", name="12month"))
-    fig.update_layout({'title': data.columns.values[1] + " 5年趋势图"}, yaxis_range=[0, 100])
-    plotly.offline.plot(fig, filename=path + data.columns.values[1] + ".html", auto_open=False)
+    # 批量模式按锚点换算后可能超过100
+    fig.update_layout({'title': data.columns.values[1] + " 5年趋势图"},
+                      yaxis_range=[0, max(100, data[data.columns.values[1]].max())])
+    return fig
+
+
+def gtrendplotly(data, path, include_plotlyjs=True):
+    """单个主题的趋势图html, include_plotlyjs 为 'plotly.min.js' 时引用同目录下共用的 plotly.js 而不是内嵌"""
+    import plotly.offline
+
+    plotly.offline.plot(gtrendfigure(data), filename=os.path.join(path, data.columns.values[1] + ".html"), auto_open=False,
+                        include_plotlyjs=include_plotlyjs)
+
+
+# 趋势图格式: files 每个主题一个html(共用一份plotly.js), dashboard 所有主题一个html, png/svg 静态图片(需要kaleido)
+CHART_FORMATS = ('files', 'dashboard', 'png', 'svg', 'none')
 
 
-def configfunc():
-    if os.path.exists("config.json"):
-        fd = open("config.json")
+def stage_timer(metrics, stage):
+    """metrics.timer(stage), 没有 metrics 时不计时"""
+    return metrics.timer(stage) if metrics is not None else contextlib.nullcontext()
+
+
+def render_chart(data, path, fmt):
+    """一个主题的趋势图文件(files/png/svg)"""
+    if fmt == 'files':
+        gtrendplotly(data, path, include_plotlyjs='plotly.min.js')
+    else:
+        gtrendfigure(data).write_image(os.path.join(path, data.columns.values[1] + "." + fmt))
+
+
+def render_charts(store_path, keywords, path, fmt, metrics=None):
+    """从 ReportStore 读取趋势并绘制 keywords 的趋势图, 可在子进程中运行; 每张图记为 metrics 的 chart 阶段"""
+    store = ReportStore(store_path)
+    try:
+        for kw in keywords:
+            data = store.trend(kw)
+            with stage_timer(metrics, 'chart'):
+                render_chart(data, path, fmt)
+    finally:
+        store.close()
+    return len(keywords)
+
+
+def render_dashboard(store, keywords, filename, metrics=None):
+    """所有主题的趋势图写入同一个html, plotly.js 只内嵌一次"""
+    with open(filename, 'w', encoding='utf-8') as fd:
+        fd.write('<html><head><meta charset="utf-8"/></head><body>\n')
+        for idx, kw in enumerate(keywords):
+            data = store.trend(kw)
+            with stage_timer(metrics, 'chart'):
+                fd.write(gtrendfigure(data).to_html(full_html=False, include_plotlyjs=idx == 0))
+            fd.write('\n')
+        fd.write('</body></html>\n')
+
+
+def render_stage(store, path, fmt='files', workers=1, metrics=None):
+    """数据收集完成后统一绘制趋势图, workers > 1 时用进程池并行
+
+    metrics: 在本进程绘制时记录每张图的耗时(chart 阶段), 子进程中绘制的图不记录
+    """
+    if fmt not in CHART_FORMATS:
+        raise ValueError('charts must be one of ' + ', '.join(CHART_FORMATS))
+    keywords = store.trend_keywords()
+    if fmt == 'none' or not keywords:
+        return
+    print("\n绘制趋势图({}): {}个主题...".format(fmt, len(keywords)))
+    if fmt == 'dashboard':
+        render_dashboard(store, keywords, os.path.join(path, "趋势图.html"), metrics)
+        return
+    if fmt == 'files':
+        import plotly.offline
+
+        # 所有html共用一份 plotly.js
+        with open(os.path.join(path, "plotly.min.js"), 'w', encoding='utf-8') as fd:
+            fd.write(plotly.offline.get_plotlyjs())
+    else:
+        try:
+            import kaleido  # noqa: F401
+        except ImportError:
+            print("导出静态图片需要kaleido(pip install kaleido), 跳过绘图")
+            return
+    if workers > 1:
+        chunks = [keywords[k::workers] for k in range(workers)]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for future in [executor.submit(render_charts, store.path, chunk, path, fmt) for chunk in chunks]:
+                future.result()
+    else:
+        render_charts(store.path, keywords, path, fmt, metrics)
+
+
+def configfunc(path="config.json", interactive=True):
+    if os.path.exists(path):
+        fd = open(path, encoding='utf-8')
+    elif not interactive:
+        raise FileNotFoundError("找不到配置文件: {}".format(path))
     else:
         configpath = input("输入配置文件路径:\n")
-        fd = open(configpath.replace("\'", "").replace("\"", ""))
+        fd = open(configpath.replace("\'", "").replace("\"", ""), encoding='utf-8')
     config = fd.read()
     fd.close()
+    # 去掉 // 注释, 字符串(如代理地址 http://...)原样保留
+    config = re.sub(r'("(?:\\.|[^"\\])*")|//[^\n]*', lambda match: match.group(1) or '', config)
     config = json.loads(config)
     return config
 
 
-def main():
-    config = configfunc()
+class Status(enum.IntEnum):
+    """主题结果中每一部分(趋势、5年相关主题、7天相关主题)的状态, 以整数存入 ReportStore"""
+    OK = 0
+    EMPTY = 1  # Google没有数据
+    TIMEOUT = 2  # 请求(含重试)失败
+    POST = 3  # explore请求失败, 通常是主题有问题
+
+
+# 汇总报告中没有结果的主题后追加的说明, 按 Status 取值
+STATUS_SUFFIX = ('', '', "超时异常", "POST请求异常, 请检查主题")
+
+
+class KeywordResult:
+    """一个主题的请求结果
+
+    三部分各一个 Status; 趋势只保留 (日期, 值, isPartial) 三个数组, 相关主题按表名保存为 (列名, 行) 元组,
+    不保留请求返回的 DataFrame。所有部分都是 OK/EMPTY 时 done 为真, 否则重新运行时会再次请求。
+    """
+    __slots__ = ('keyword', 'trend_status', 'related5y_status', 'related7d_status', 'trend', 'topics',
+                 'trendurl', 'topicurl')
+
+    def __init__(self, keyword):
+        self.keyword = keyword
+        self.trend_status = self.related5y_status = self.related7d_status = Status.TIMEOUT
+        self.trend = None
+        # 表名(ReportStore.TOPIC_SHEETS) -> (列名, 行)
+        self.topics = dict()
+        self.trendurl = None
+        self.topicurl = None
+
+    @property
+    def done(self):
+        return max(self.trend_status, self.related5y_status, self.related7d_status) <= Status.EMPTY
+
+    def fail(self, status):
+        """POST或5年趋势请求失败, 三部分都记为 status"""
+        self.trend_status = self.related5y_status = self.related7d_status = status
+
+    def set_trend(self, df):
+        """df: interest_over_time 的结果(可以有多个主题的列), 无趋势时5年相关主题也记为无数据"""
+        if df.empty:
+            print("该主题无趋势")
+            self.trend_status = self.related5y_status = Status.EMPTY
+            return
+        self.trend_status = Status.OK
+        self.trend = (df.index.values, df[self.keyword].to_numpy(dtype='float64'), df['isPartial'].to_numpy(dtype=bool))
+
+    def set_related5y(self, related):
+        """related: related_topics(records=True) 的结果, 上升和热门主题都有时才算有5年相关主题; None 或没有该主题时记为失败"""
+        tables = None if related is None else related.get(self.keyword)
+        if tables is None:
+            self.related5y_status = Status.TIMEOUT
+            return
+        if self._empty(tables["rising"]) or self._empty(tables["top"]):
+            print("该主题无5年相关主题")
+            self.related5y_status = Status.EMPTY
+            return
+        self.related5y_status = Status.OK
+        self.topics["rising-5year"] = tables["rising"]
+        self.topics["top-5year"] = tables["top"]
+
+    def set_related7d(self, related):
+        """related: related_topics(records=True) 的结果, 上升或热门主题有一个即算有7天相关主题; None 或没有该主题时记为失败"""
+        tables = None if related is None else related.get(self.keyword)
+        if tables is None:
+            self.related7d_status = Status.TIMEOUT
+            return
+        if self._empty(tables["rising"]) and self._empty(tables["top"]):
+            print("该主题无7天相关主题")
+            self.related7d_status = Status.EMPTY
+            return
+        self.related7d_status = Status.OK
+        for kind, sheet, name in (("rising", "rising-7day", "上升"), ("top", "top-7day", "热门")):
+            if self._empty(tables[kind]):
+                print("该主题无7天相关{}主题".format(name))
+            else:
+                self.topics[sheet] = tables[kind]
+
+    @staticmethod
+    def _empty(table):
+        """table: (列名, 行) 或 None"""
+        return table is None or not table[1]
+
+# (趋势和相关主题的时间范围, 相关主题的第二个时间范围), 报告中仍称为5年和7天; 可用配置 trend_timeframe/topics_timeframe 修改
+TIMEFRAMES = ("today 5-y", "now 7-d")
+
+
+def config_timeframes(config):
+    return config.get("trend_timeframe", TIMEFRAMES[0]), config.get("topics_timeframe", TIMEFRAMES[1])
+
+
+def fetch_keyword(trends, kw, pause=True, timeframes=TIMEFRAMES, trend_store=None):
+    """请求单个主题的5年趋势、5年相关主题和7天相关主题, 时间范围见 TIMEFRAMES
+
+    有 trend_store (TrendStore) 时5年趋势增量更新, 见 refresh_trend; 返回 KeywordResult
+    """
+    result = KeywordResult(kw)
+    # 每个主题的所有请求(含重试)共用一个期限
+    trends.start_deadline()
+    #  五年趋势
+    print("请求5年POST...")
+    if not trends.build_payload([kw], timeframe=timeframes[0]):
+        print("{}:请求5年POST异常".format(kw))
+        result.fail(Status.POST)
+        return result
+
+    if trend_store is None:
+        # 5年趋势和5年相关主题同时请求
+        print("\n请求5年趋势和5年相关主题...")
+        explore = trends.fetch_all(widgets=('interest_over_time', 'related_topics'), records=True)
+        df = explore.interest_over_time
+        related = explore.related_topics if explore.complete('related_topics') else None
+    else:
+        # 先请求5年相关主题, 再用同一个payload增量更新趋势
+        print("\n请求5年相关主题...")
+        related = trends.related_topics(records=True)
+        df = refresh_trend(trends, kw, timeframes[0], trend_store)
+    result.trendurl = trends.INTEREST_OVER_TIME_URL + "?" + trends.prepare_gettrend_url
+    if df is None:
+        result.fail(Status.TIMEOUT)
+        return result
+    result.set_trend(df)
+    if not df.empty:
+        result.set_related5y(related)
+
+    if pause:
+        time.sleep(random.uniform(1, 3))
+    # 7天主题
+    print("\n请求7天POST...")
+    if not trends.build_payload([kw], timeframe=timeframes[1]):
+        # 不能再用5年的widget请求相关主题
+        print("{}:请求7天POST异常".format(kw))
+        result.set_related7d(None)
+        return result
+    # 获取相关主题
+    print("\n请求7天相关主题...")
+    result.set_related7d(trends.related_topics(records=True))
+    result.topicurl = trends.RELATED_QUERIES_URL + "?" + trends.prepare_getrelatedtopic_url
+    return result
+
+
+def fetch_single(trends, kws, pause=True, timeframes=TIMEFRAMES, trend_store=None):
+    """非批量模式, kws 中只有一个主题"""
+    return [fetch_keyword(trends, kw, pause, timeframes, trend_store) for kw in kws]
+
+
+def trend_window(trends, kw, timeframe, store):
+    """(分辨率, 增量请求的短窗口), 按小时/月的时间范围或没有可拼接的历史时短窗口为 None"""
+    resolution = TrendStore.resolution(timeframe)
+    return resolution, store.window(kw, trends.geo, resolution) if resolution else None
+
+
+def stitch_trend(kw, geo, timeframe, store, resolution, df):
+    """短窗口趋势 df 拼接到历史后 timeframe 内的趋势, 无法拼接返回 None"""
+    if df is None or df.empty or not store.extend(kw, geo, df):
+        print("无法与本地历史拼接, 使用完整趋势...")
+        return None
+    start = pd.Timestamp.now().normalize() - pd.Timedelta(days=TrendStore.span_days(timeframe))
+    return store.trend(kw, geo, resolution, start)
+
+
+def save_trend(kw, geo, store, resolution, df):
+    """完整趋势替换历史, 返回 df"""
+    if df is not None and not df.empty and resolution:
+        store.save(kw, geo, df)
+    return df
+
+
+def refresh_trend(trends, kw, timeframe, store):
+    """kw 在 timeframe 内的趋势(interest_over_time 格式), 请求失败返回 None; trends 需已按 timeframe build_payload
+
+    store (TrendStore) 中有历史时只请求历史末尾之后的短窗口(与历史重叠 store.overlap 个点), 按重叠部分换算到历史的比例
+    后拼接; 没有历史、无法拼接或按小时/月的时间范围时用 trends 的完整趋势并替换历史. 短窗口在 trends 的浅拷贝上请求,
+    不换掉 trends 的payload, 无法拼接时不用再POST一次.
+    相关主题仍要完整时间范围的payload, 所以增量时每个主题多一次短窗口的POST(5年+7天共6个请求, 非增量5个);
+    省下的是趋势响应的大小(约 overlap+新增的点数, 而不是5年的260周), 并且历史会保留超出时间范围的部分
+    """
+    resolution, window = trend_window(trends, kw, timeframe, store)
+    if window is not None:
+        print("\n增量请求趋势: {}...".format(window))
+        client = copy.copy(trends)
+        df = client.interest_over_time() if client.build_payload([kw], timeframe=window) else None
+        df = stitch_trend(kw, trends.geo, timeframe, store, resolution, df)
+        if df is not None:
+            trends.prepare_gettrend_url = client.prepare_gettrend_url
+            return df
+    else:
+        print("\n请求5年趋势...")
+    return save_trend(kw, trends.geo, store, resolution, trends.interest_over_time())
+
+
+async def async_refresh_trend(trends, kw, timeframe, store):
+    """refresh_trend 的异步版本"""
+    resolution, window = trend_window(trends, kw, timeframe, store)
+    if window is not None:
+        print("\n增量请求趋势: {}...".format(window))
+        client = copy.copy(trends)
+        df = await client.interest_over_time() if await client.build_payload([kw], timeframe=window) else None
+        df = stitch_trend(kw, trends.geo, timeframe, store, resolution, df)
+        if df is not None:
+            trends.prepare_gettrend_url = client.prepare_gettrend_url
+            return df
+    else:
+        print("\n请求5年趋势...")
+    return save_trend(kw, trends.geo, store, resolution, await trends.interest_over_time())
+
+
+def fetch_daily(trends, kw, start, end, store):
+    """用多个相互重叠的短窗口拼接出 start 到 end 的每日趋势, 结果存入 store (TrendStore)
+
+    每个窗口不超过 TrendStore.MAX_DAYS['day'] 天(更长的窗口Google只返回每周数据), 与上一个窗口重叠 store.overlap 天;
+    返回 0-100 的每日趋势(interest_over_time 格式), 某个窗口请求失败或无法拼接时返回 None
+    """
+    start, end = pd.Timestamp(start), pd.Timestamp(end)
+    span = pd.Timedelta(days=TrendStore.MAX_DAYS['day'] - 1)
+    day = start
+    while True:
+        stop = min(day + span, end)
+        timeframe = '{:%Y-%m-%d} {:%Y-%m-%d}'.format(day, stop)
+        print("请求每日趋势: {}...".format(timeframe))
+        if not trends.build_payload([kw], timeframe=timeframe):
+            return None
+        df = trends.interest_over_time()
+        if df is None or df.empty:
+            return None
+        if not (store.save(kw, trends.geo, df) if day == start else store.extend(kw, trends.geo, df)):
+            print("{}: 窗口{}无法与前面的窗口拼接".format(kw, timeframe))
+            return None
+        if stop >= end:
+            return store.trend(kw, trends.geo, 'day', start)
+        day = stop - pd.Timedelta(days=store.overlap - 1)
+
+
+# 批量模式下每批的主题数, explore最多5个主题, 留一个给锚点主题
+BATCH_SIZE = 4
+
+
+def fetch_reference(trends, anchor, timeframe=TIMEFRAMES[0]):
+    """单独请求锚点主题的5年趋势, 作为批量模式下各批次换算的统一比例"""
+    print("请求锚点主题{}的5年趋势...".format(anchor))
+    trends.start_deadline()
+    if not trends.build_payload([anchor], timeframe=timeframe):
+        return None
+    df = trends.interest_over_time()
+    if df is None or df.empty:
+        return None
+    return df[anchor]
+
+
+def rescale_to_anchor(df, anchor, reference):
+    """Google按批次把趋势归一化到0-100, 按锚点主题在本批和 reference 中的比例换算到同一比例"""
+    common = df.index.intersection(reference.index) if reference is not None else df.index[:0]
+    total = df.loc[common, anchor].sum()
+    if total == 0:
+        print("锚点主题{}在本批中无数据, 本批趋势未换算".format(anchor))
+        return df
+    factor = reference[common].sum() / total
+    scaled = df.copy()
+    columns = [column for column in df.columns if column != 'isPartial']
+    scaled[columns] = df[columns] * factor
+    return scaled
+
+
+def fetch_batch(trends, kws, anchor, reference, pause=True, timeframes=TIMEFRAMES):
+    """批量模式: kws(最多 BATCH_SIZE 个)和锚点主题一起请求5年趋势, 7天相关主题也按批请求
+
+    每个主题的趋势按锚点换算后拆分, 相关主题按 complexKeywordsRestriction 的主题对应; 在批次中全为0的主题
+    (搜索量远小于同批主题时会被取整为0)再用 fetch_keyword 单独请求, 其趋势不按锚点换算; 返回与 kws 顺序一致的
+    KeywordResult
+    """
+    results = [KeywordResult(kw) for kw in kws]
+    trends.start_deadline(len(kws))
+    print("请求5年POST...")
+    if not trends.build_payload(kws if anchor in kws else kws + [anchor], timeframe=timeframes[0]):
+        print("{}:请求5年POST异常".format(", ".join(kws)))
+        for result in results:
+            result.fail(Status.POST)
+        return results
+
+    print("\n请求5年趋势...")
+    df = trends.interest_over_time()
+    for result in results:
+        result.trendurl = trends.INTEREST_OVER_TIME_URL + "?" + trends.prepare_gettrend_url
+        if df is None:
+            result.fail(Status.TIMEOUT)
+    if df is None:
+        return results
+
+    # 单独请求时无数据的主题Google返回空趋势, 批量请求时则是全0
+    with_trend = [kw for kw in kws if not df.empty and df[kw].any()]
+    if with_trend:
+        df = rescale_to_anchor(df, anchor, reference)
+        print("\n请求5年相关主题...")
+        related_topics_5y = trends.related_topics(keywords=with_trend, records=True)
+    for result in results:
+        if result.keyword in with_trend:
+            result.set_trend(df)
+            result.set_related5y(related_topics_5y)
+        else:
+            result.set_trend(pd.DataFrame())
+
+    if pause:
+        time.sleep(random.uniform(1, 3))
+    print("\n请求7天POST...")
+    related_topics_7d = None
+    if trends.build_payload(kws, timeframe=timeframes[1]):
+        print("\n请求7天相关主题...")
+        related_topics_7d = trends.related_topics(records=True)
+    else:
+        print("{}:请求7天POST异常".format(", ".join(kws)))
+    for result in results:
+        result.set_related7d(related_topics_7d)
+        result.topicurl = trends.RELATED_QUERIES_URL + "?" + trends.prepare_getrelatedtopic_urls.get(
+            result.keyword, trends.prepare_getrelatedtopic_url)
+
+    for k, kw in enumerate(kws):
+        if kw not in with_trend:
+            print("\n{}在批次中无趋势, 单独请求...".format(kw))
+            results[k] = fetch_keyword(trends, kw, pause=False, timeframes=timeframes)
+    return results
+
+
+class ReportStore:
+    """运行结果的SQLite存储, 每个主题处理完立即在一个事务中写入, 结束时再流式导出Excel
+
+    results: 每个主题一行(行号、主题、三部分的 Status、url); trend: 5年趋势; topics: 每个主题每张相关主题表一行,
+    列名和压缩后的行分开保存。数据库放在报告目录, 重新运行时跳过 results 中已成功的主题(断点续跑)。
+    """
+    # 相关主题文件中各表的顺序
+    TOPIC_SHEETS = ('rising-5year', 'top-5year', 'rising-7day', 'top-7day')
+    # results 表中各部分的 Status 列
+    PARTS = ('trend', 'related5y', 'related7d')
+    # 汇总报告: (表名, ((列名, 部分, 是否有结果), ...))
+    REPORT_SHEETS = (
+        ("有趋势图", (('有趋势图的主题', 'trend', True), ('5年有相关主题的主题', 'related5y', True),
+                  ('7天有相关主题的主题', 'related7d', True))),
+        ("无趋势图", (('无趋势图的主题', 'trend', False), ('5年无相关主题的主题', 'related5y', False),
+                  ('7天无相关主题的主题', 'related7d', False))),
+    )
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS results (idx INTEGER PRIMARY KEY, keyword TEXT, trend INTEGER,
+                                                related5y INTEGER, related7d INTEGER, trendurl TEXT, topicurl TEXT);
+            CREATE TABLE IF NOT EXISTS trend (keyword TEXT, date TEXT, value REAL, partial INTEGER);
+            CREATE INDEX IF NOT EXISTS trend_keyword ON trend (keyword);
+            CREATE TABLE IF NOT EXISTS topics (keyword TEXT, sheet TEXT, columns TEXT, rows BLOB,
+                                               PRIMARY KEY (keyword, sheet));
+        """)
+
+    def prune(self, keywords):
+        """删除不属于当前输入表格的结果(表格改动后行号对应的主题变了), 以及不再有结果行的主题的趋势和相关主题"""
+        with self.lock, self.conn:
+            rows = self.conn.execute('SELECT idx, keyword FROM results').fetchall()
+            stale = [(i, kw) for i, kw in rows if i >= len(keywords) or keywords[i] != kw]
+            self.conn.executemany('DELETE FROM results WHERE idx = ? AND keyword = ?', stale)
+            self.conn.execute('DELETE FROM trend WHERE keyword NOT IN (SELECT keyword FROM results)')
+            self.conn.execute('DELETE FROM topics WHERE keyword NOT IN (SELECT keyword FROM results)')
+
+    def done(self):
+        """已成功(各部分都是 OK/EMPTY)的 (行号, 主题), 断点续跑时跳过; 结果和状态在同一个事务中写入"""
+        with self.lock:
+            return set(self.conn.execute('SELECT idx, keyword FROM results WHERE MAX(trend, related5y, related7d) <= ?',
+                                         (int(Status.EMPTY),)))
+
+    def save_keyword(self, index, result):
+        """一个事务内写入一个主题的全部结果(KeywordResult), 覆盖该主题之前的结果"""
+        kw = result.keyword
+        with self.lock, self.conn:
+            self.conn.execute('DELETE FROM trend WHERE keyword = ?', (kw,))
+            self.conn.execute('DELETE FROM topics WHERE keyword = ?', (kw,))
+            self.conn.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?)', (
+                index, kw, int(result.trend_status), int(result.related5y_status), int(result.related7d_status),
+                result.trendurl, result.topicurl))
+            if result.trend is not None:
+                dates, values, partial = result.trend
+                self.conn.executemany('INSERT INTO trend VALUES (?, ?, ?, ?)', zip(
+                    itertools.repeat(kw), pd.DatetimeIndex(dates).strftime('%Y-%m-%d %H:%M:%S'),
+                    values.tolist(), partial.astype(int).tolist()))
+            self.conn.executemany('INSERT INTO topics VALUES (?, ?, ?, ?)', [
+                (kw, sheet, json.dumps(columns, ensure_ascii=False),
+                 zlib.compress(json.dumps(rows, ensure_ascii=False).encode('utf-8')))
+                for sheet, (columns, rows) in result.topics.items()])
+
+    def trend(self, kw):
+        """读出一个主题的趋势, 列为 date 和主题, 供绘图使用"""
+        with self.lock:
+            rows = self.conn.execute('SELECT date, value FROM trend WHERE keyword = ? ORDER BY date', (kw,)).fetchall()
+        return pd.DataFrame({'date': pd.to_datetime([row[0] for row in rows]), kw: [row[1] for row in rows]})
+
+    def trend_keywords(self):
+        """有趋势图的主题, 按输入顺序"""
+        with self.lock:
+            return [kw for (kw,) in self.conn.execute('SELECT keyword FROM results WHERE trend = ? ORDER BY idx',
+                                                      (int(Status.OK),))]
+
+    def summary(self):
+        """所有主题的结果, 每个主题一行, 按输入顺序; 各部分的列为 Status 的整数值"""
+        with self.lock:
+            return pd.read_sql_query('SELECT * FROM results ORDER BY idx', self.conn)
+
+    def report_columns(self, summary=None, keywords=None):
+        """汇总报告各列: {(部分, 是否有结果): 主题列表}, 没有结果的主题按 Status 追加说明
+
+        keywords 为输入表格的全部主题时, 数据库中没有结果行的主题(如分片未运行)追加到每个没有结果的列
+        """
+        summary = self.summary() if summary is None else summary
+        missing = [] if keywords is None else self.missing(keywords, summary)
+        names = summary['keyword'].to_numpy(dtype=object)
+        suffix = np.array(STATUS_SUFFIX, dtype=object)
+        columns = dict()
+        for part in self.PARTS:
+            # 没有结果时 read_sql_query 给出 object 列
+            status = summary[part].to_numpy(dtype='int64')
+            ok = status == Status.OK
+            columns[part, True] = names[ok].tolist()
+            columns[part, False] = (names[~ok] + suffix[status[~ok]]).tolist() + [
+                kw + "未请求" for kw in missing]
+        return columns
+
+    def missing(self, keywords, summary=None):
+        """输入表格中还没有结果行的主题, 按输入顺序"""
+        summary = self.summary() if summary is None else summary
+        saved = set(summary['idx'].tolist())
+        return [kw for i, kw in enumerate(keywords) if i not in saved]
+
+    def export_report(self, path, df_subj):
+        """以只写模式流式导出汇总报告(主题趋势报告.xlsx)"""
+        from openpyxl import Workbook
+
+        summary = self.summary()
+        columns = self.report_columns(summary, list(df_subj[df_subj.columns[0]]))
+        workbook = Workbook(write_only=True)
+        for title, headers in self.REPORT_SHEETS:
+            sheet = workbook.create_sheet(title)
+            sheet.append([header for header, _, _ in headers])
+            for row in itertools.zip_longest(*[columns[part, ok] for _, part, ok in headers]):
+                sheet.append(list(row))
+
+        # url按行号对应输入表格, 没有结果的行留空
+        urls = summary.set_index('idx')[['trendurl', 'topicurl']].reindex(range(len(df_subj)))
+        urls = urls.astype(object).where(urls.notna(), None)
+        sheet = workbook.create_sheet("url")
+        sheet.append([str(column) for column in df_subj.columns] + ['获取趋势url', '获取7天主题url'])
+        for subj, trendurl, topicurl in zip(df_subj.itertuples(index=False), urls['trendurl'], urls['topicurl']):
+            sheet.append([None if pd.isna(cell) else cell for cell in subj] + [trendurl, topicurl])
+        workbook.save(path)
+
+    def topic_tables(self, kw):
+        """一个主题的相关主题表: [(表名, 列名, 行)], 按 TOPIC_SHEETS 的顺序"""
+        with self.lock:
+            rows = self.conn.execute('SELECT sheet, columns, rows FROM topics WHERE keyword = ?', (kw,)).fetchall()
+        tables = {sheet: (json.loads(columns), json.loads(zlib.decompress(blob))) for sheet, columns, blob in rows}
+        return [(sheet,) + tables[sheet] for sheet in self.TOPIC_SHEETS if sheet in tables]
+
+    def export_topics(self, folder, metrics=None):
+        """以只写模式为每个有相关主题的主题导出 <主题>-risingtop.xlsx, 每次只读入一个主题
+
+        metrics: 记录每个文件的耗时(topics_xlsx 阶段)
+        """
+        with self.lock:
+            keywords = [kw for (kw,) in self.conn.execute(
+                'SELECT DISTINCT keyword FROM topics WHERE keyword IN (SELECT keyword FROM results)')]
+        for kw in keywords:
+            with stage_timer(metrics, 'topics_xlsx'):
+                self.export_keyword_topics(kw, folder)
+
+    def export_keyword_topics(self, kw, folder):
+        """以只写模式导出一个主题的 <主题>-risingtop.xlsx"""
+        from openpyxl import Workbook
+
+        workbook = Workbook(write_only=True)
+        for title, columns, rows in self.topic_tables(kw):
+            sheet = workbook.create_sheet(title)
+            sheet.append(columns)
+            for row in rows:
+                sheet.append(row)
+        workbook.save(os.path.join(folder, kw + "-risingtop.xlsx"))
+
+    def merge(self, path):
+        """并入另一个数据库(分片)的结果, 覆盖其中各行号和主题之前的结果"""
+        with self.lock:
+            self.conn.execute('ATTACH DATABASE ? AS shard', (path,))
+            try:
+                with self.conn:
+                    self.conn.execute('DELETE FROM trend WHERE keyword IN (SELECT keyword FROM shard.results)')
+                    self.conn.execute('DELETE FROM topics WHERE keyword IN (SELECT keyword FROM shard.results)')
+                    self.conn.execute('INSERT OR REPLACE INTO results SELECT * FROM shard.results')
+                    self.conn.execute('INSERT INTO trend SELECT * FROM shard.trend')
+                    self.conn.execute('INSERT INTO topics SELECT * FROM shard.topics')
+            finally:
+                self.conn.execute('DETACH DATABASE shard')
+
+    def close(self):
+        self.conn.close()
+
+
+def run_concurrent(units, clients, fetch, finish):
+    """多线程处理主题, 每个客户端同一时刻只服务一个线程
+
+    units: [[(行号, 主题), ...]], 每个单元的主题一起请求; fetch(客户端, 主题列表, pause) 返回各主题的请求结果
+    (fetch_single 或 fetch_batch); finish(行号, 请求结果) 保存结果; 返回 finish 的返回值, 按单元展开, 顺序不变
+    """
+    idle = queue.Queue()
+    for client in clients:
+        idle.put(client)
+
+    def task(unit):
+        trends = idle.get()
+        try:
+            print(", ".join("{}-{}".format(i + 1, kw) for i, kw in unit) + ":")
+            results = fetch(trends, [kw for _, kw in unit], pause=False)
+            return [finish(i, result) for (i, _), result in zip(unit, results)]
+        finally:
+            idle.put(trends)
+
+    with ThreadPoolExecutor(max_workers=len(clients)) as executor:
+        futures = [executor.submit(task, unit) for unit in units]
+        return [entries for future in futures for entries in future.result()]
+
+
+async def async_fetch_keyword(trends, kw, timeframes=TIMEFRAMES, trend_store=None):
+    """fetch_keyword 的异步版本
+
+    5年和7天两条请求链同时进行, 5年趋势和5年相关主题也同时请求; 返回 KeywordResult
+    """
+    result = KeywordResult(kw)
+    five_year = trends.fork()
+    seven_day = trends.fork()
+    for client in (five_year, seven_day):
+        client.start_deadline()
+
+    async def fetch_5y():
+        print("请求5年POST...")
+        if not await five_year.build_payload([kw], timeframe=timeframes[0]):
+            print("{}:请求5年POST异常".format(kw))
+            return False, None, None
+        if trend_store is not None:
+            print("\n请求5年相关主题...")
+            related = await five_year.related_topics(records=True)
+            return True, await async_refresh_trend(five_year, kw, timeframes[0], trend_store), related
+        print("\n请求5年趋势和5年相关主题...")
+        explore = await five_year.fetch_all(widgets=('interest_over_time', 'related_topics'), records=True)
+        related = explore.related_topics if explore.complete('related_topics') else None
+        return True, explore.interest_over_time, related
+
+    async def fetch_7d():
+        print("\n请求7天POST...")
+        if not await seven_day.build_payload([kw], timeframe=timeframes[1]):
+            print("{}:请求7天POST异常".format(kw))
+            return None
+        print("\n请求7天相关主题...")
+        return await seven_day.related_topics(records=True)
+
+    (posted, df, related_5y), related_7d = await asyncio.gather(fetch_5y(), fetch_7d())
+    if not posted:
+        result.fail(Status.POST)
+        return result
+    result.trendurl = trends.INTEREST_OVER_TIME_URL + "?" + five_year.prepare_gettrend_url
+    if df is None:
+        result.fail(Status.TIMEOUT)
+        return result
+    result.set_trend(df)
+    if not df.empty:
+        result.set_related5y(related_5y)
+    result.set_related7d(related_7d)
+    result.topicurl = trends.RELATED_QUERIES_URL + "?" + seven_day.prepare_getrelatedtopic_url
+    return result
+
+
+async def run_async(items, config, options, finish, trend_store=None):
+    """单线程异步处理主题, 同时最多 concurrency 个主题在请求中, 每次请求从代理池选择代理
+
+    items 和 finish 同 run_concurrent, options: 创建客户端的参数, 见 collect()
+    """
+    trends = AsyncGtrendReq(**options)
+    semaphore = asyncio.Semaphore(config.get("concurrency", 50))
+    loop = asyncio.get_running_loop()
+
+    async def task(i, kw):
+        async with semaphore:
+            print("{}-{}:".format(i + 1, kw))
+            result = await async_fetch_keyword(trends, kw, config_timeframes(config), trend_store)
+        # 绘图和写Excel会阻塞, 放到线程池中执行
+        return await loop.run_in_executor(None, finish, i, result)
+
+    try:
+        return await asyncio.gather(*[task(i, kw) for i, kw in items])
+    finally:
+        await trends.close()
+
+
+def report_dir(filepath):
+    """输入表格对应的报告目录: 与表格同目录的 <表格名>-主题趋势报告"""
+    filepath = os.path.abspath(filepath)
+    return os.path.join(os.path.dirname(filepath), os.path.splitext(os.path.basename(filepath))[0] + "-主题趋势报告")
+
+
+def read_subjects(filepath):
+    """读取主题表格(Excel或CSV), 第一列为主题"""
+    if filepath.lower().endswith('.csv'):
+        return pd.read_csv(filepath)
+    return pd.read_excel(filepath)
+
+
+def collect(config, keywords, workdir, rows=None, metrics=None):
+    """请求 keywords 中 rows 行(默认全部)的主题, 结果边请求边写入 workdir 下的 主题趋势报告.sqlite
+
+    请求追踪和响应缓存也放在 workdir; metrics: 记录请求统计的 Metrics, 默认新建;
+    返回 (ReportStore, Metrics, 本次运行信息)
+    """
     # print(config)
-    os.environ["https_proxy"] = config["https_proxy"][random.randint(0, len(config["https_proxy"]) - 1)]
-    print(os.environ["https_proxy"])
     # headers = config["hearders"]
     # print(headers)
     headers = {key: config[key] for key in config.keys() if
                key == "user-agent" or key == "authority" or key == "cookie"}
     # print(headers)
+    rows = range(len(keywords)) if rows is None else rows
+    # 并发线程数; 线程共用代理池, 每个请求各自选代理, 每个代理的负载由其限速(rate/burst)控制, 不按代理数限制线程数
+    workers = max(config.get("workers", 1), 1)
+
+    # explore token缓存, 所有客户端共用
+    token_cache = TokenCache(ttl=config.get("token_cache_ttl", 3600), maxsize=config.get("token_cache_size", 1024),
+                             path=config.get("token_cache_file"))
+    # 代理池: 每次请求按各代理的延迟和成功率选择代理, 连续失败(429/5xx/连接异常)的代理暂停使用, 每个代理各自限速
+    pool = ProxyPool(config["https_proxy"], rate=config.get("rate", 0), burst=config.get("burst", 1),
+                     cooldown=config.get("proxy_cooldown", 60), failures=config.get("proxy_failures", 3))
+    # 原始响应的录制/回放/缓存, 回放模式下不访问Google
+    response_mode = config.get("response_mode", "off")
+    response_store = None
+    if response_mode != "off":
+        response_store = ResponseStore(config.get("response_store") or os.path.join(workdir, "响应缓存.sqlite"),
+                                       mode=response_mode, ttl=config.get("response_ttl", 86400),
+                                       latency=config.get("replay_latency", 0),
+                                       error_rate=config.get("replay_error_rate", 0))
+        print("响应{}模式: {}".format(response_mode, response_store.path))
+    # 增量更新: 本地保存各主题的趋势历史, 之后的运行只请求最近一段并拼接到历史上
+    trend_store = None
+    if config.get("incremental", False):
+        trend_store = TrendStore(config.get("trend_store") or os.path.join(workdir, "趋势历史.sqlite"),
+                                 overlap=config.get("trend_overlap", 8))
+        print("增量更新趋势: {}".format(trend_store.path))
+    # 请求统计, 结束时写入 请求统计.json; trace 为 true 时每次请求再追加一行到 请求追踪.jsonl
+    if metrics is None:
+        metrics = Metrics(os.path.join(workdir, "请求追踪.jsonl") if config.get("trace", False) else None)
+    # 重试策略: 429/5xx/超时/代理异常/验证码页面才重试, 指数退避并遵守Retry-After, 每个主题有总的请求期限
+    retry_policy = RetryPolicy(base=config.get("backoff_base", 1), cap=config.get("backoff_cap", 30),
+                               deadline=config.get("deadline", 180), connect_timeout=config.get("connect_timeout", 10),
+                               read_timeout=config.get("read_timeout", 30))
+    options = dict(hl=config["hl"], tz=config["tz"], retries=config["retries"], headers=headers,
+                   pool_connections=config.get("pool_connections", 10), pool_maxsize=config.get("pool_maxsize", 10),
+                   token_cache=token_cache, pool=pool, retry_policy=retry_policy, metrics=metrics,
+                   verbosity=config.get("verbosity", 1), response_store=response_store)
 
-    filepath = input("文件路径:\n")
-    filepath = filepath.replace("\'", "").replace("\"", "")
-    df_subj = pd.read_excel(filepath)
-    parentpath = os.path.dirname(filepath) + "\\"
-    gtrendhtmlpath = parentpath + os.path.splitext(os.path.basename(filepath))[0] + "-主题趋势报告" + "\\"
+    # 结果边请求边写入数据库, 不在内存中累积
+    store = ReportStore(os.path.join(workdir, "主题趋势报告.sqlite"))
+    store.prune(keywords)
+    # 断点续跑: 跳过数据库中已成功的主题, 失败和未处理的主题重新请求
+    done = store.done()
+    items = [(i, keywords[i]) for i in rows if (i, keywords[i]) not in done]
+    if len(items) < len(rows):
+        print("跳过已完成的主题{}个, 剩余{}个".format(len(rows) - len(items), len(items)))
+    failed = list()
 
-    # input(gtrendhtmlpath)
-    if not os.path.isdir(gtrendhtmlpath):
-        os.mkdir(gtrendhtmlpath)
+    def finish(i, result):
+        store.save_keyword(i, result)
+        if not result.done:
+            failed.append(i)
+
+    print("\n开始获取数据...")
+    time_start = time.time()
+    if config.get("async", False):
+        print("异步模式: 最多{}个主题同时请求".format(config.get("concurrency", 50)))
+        if config.get("batch", False):
+            print("异步模式不支持批量请求, 按单个主题请求")
+        asyncio.run(run_async(items, config, options, finish, trend_store))
+        clients = list()
+    else:
+        if workers > 1:
+            print("并发模式: {}个线程".format(workers))
+        # 每个线程一个客户端, 客户端共用代理池
+        clients = [GtrendReq(**options) for _ in range(workers)]
+        trends = clients[0]
+
+        units = [[item] for item in items]
+        frames = config_timeframes(config)
+        fetch = functools.partial(fetch_single, timeframes=frames, trend_store=trend_store)
+        if config.get("batch", False) and items:
+            if trend_store is not None:
+                print("批量模式的趋势按锚点换算, 不做增量更新")
+            # 批量模式: 每批带上同一个锚点主题, 按锚点把各批的趋势换算到同一比例
+            anchor = config.get("anchor") or keywords[0]
+            print("批量模式: 每批{}个主题, 锚点主题: {}".format(BATCH_SIZE, anchor))
+            reference = fetch_reference(clients[0], anchor, frames[0])
+            if reference is None:
+                # 没有锚点趋势时各批无法换算到同一比例
+                print("锚点主题{}的趋势请求失败或无数据, 改为按单个主题请求".format(anchor))
+            else:
+                fetch = functools.partial(fetch_batch, anchor=anchor, reference=reference, timeframes=frames)
+                units = [items[k:k + BATCH_SIZE] for k in range(0, len(items), BATCH_SIZE)]
+
+        if workers > 1:
+            run_concurrent(units, clients, fetch, finish)
+        else:
+            # 逐个请求时主题之间随机停顿1-3秒(配置 pause), 回放模式不需要
+            pause = config.get("pause", True) and response_mode != "replay"
+            for unit in units:
+                print(", ".join("{}-{}".format(i + 1, kw) for i, kw in unit) + ":")
+                results = fetch(trends, [kw for _, kw in unit], pause=pause)
+                for (i, _), result in zip(unit, results):
+                    finish(i, result)
+
+    elapsed = time.time() - time_start
+    for trends in clients:
+        trends.close()
+    token_cache.save()
+    print("token缓存: 命中{}次, 未命中{}次".format(token_cache.hits, token_cache.misses))
+    if response_store is not None:
+        print("响应缓存: 命中{}次, 未命中{}次".format(response_store.hits, response_store.misses))
+        response_store.close()
+    if trend_store is not None:
+        trend_store.close()
+    print("代理统计:")
+    for line in pool.summary():
+        print(line)
+
+    run = dict(keywords=len(items), failed=len(failed), seconds=elapsed,
+               keywords_per_minute=len(items) / elapsed * 60 if items and elapsed > 0 else None,
+               token_cache={'hits': token_cache.hits, 'misses': token_cache.misses}, proxy_pool=pool.summary())
+    return store, metrics, run
+
+
+def export(config, store, metrics, gtrendhtmlpath, df_subj):
+    """绘制趋势图并导出 主题趋势报告.xlsx 和各主题的相关主题xlsx"""
+    htmlfolderpath = os.path.join(gtrendhtmlpath, "趋势图")
+    relatedtopicpath = os.path.join(gtrendhtmlpath, "相关主题")
+    os.makedirs(htmlfolderpath, exist_ok=True)
+    os.makedirs(relatedtopicpath, exist_ok=True)
+    with metrics.timer('charts'):
+        render_stage(store, htmlfolderpath, config.get("charts", "files"), config.get("chart_workers", 1), metrics)
+    print("\n导出报告...")
+    with metrics.timer('excel'):
+        store.export_report(os.path.join(gtrendhtmlpath, "主题趋势报告.xlsx"), df_subj)
+        if config.get("export_xlsx", True):
+            store.export_topics(relatedtopicpath, metrics)
+
+
+def print_metrics(metrics):
+    def bound(value):
+        # None: 落在最后一个没有上限的区间
+        return "<={}s".format(value) if value is not None else ">{}s".format(Metrics.BUCKETS[-2])
+
+    for endpoint, stats in metrics.summary()['endpoints'].items():
+        print("{}: 请求{}次, 重试{}次, {:.1f}MB, 平均{:.2f}s, p50{}, p99{}".format(
+            endpoint, stats['requests'], stats['retries'], stats['bytes'] / 1e6, stats['mean'], bound(stats['p50']),
+            bound(stats['p99'])))
+
+
+def shard_rows(count, shards, shard):
+    """第 shard 个分片负责的行: 按输入顺序连续均分, 分片数不变时结果确定"""
+    return range(count * shard // shards, count * (shard + 1) // shards)
+
+
+def shard_dir(gtrendhtmlpath, shard):
+    return os.path.join(gtrendhtmlpath, "分片", "{:03d}".format(shard))
+
+
+def run_shard(config, filepath, gtrendhtmlpath, shards, shard):
+    """在子进程中处理一个分片: 独立的代理子集、客户端和工作目录, 输出写入分片目录下的 运行日志.txt
+
+    返回 (分片, 本次运行信息)
+    """
+    proxies = config["https_proxy"]
+    # 代理按分片轮流分配, 代理少于分片数时共用
+    subset = proxies[shard::shards] or [proxies[shard % len(proxies)]]
+    config = dict(config, https_proxy=subset)
+    df_subj = read_subjects(filepath)
+    keywords = list(df_subj[df_subj.columns[0]])
+    workdir = shard_dir(gtrendhtmlpath, shard)
+    os.makedirs(workdir, exist_ok=True)
+    with open(os.path.join(workdir, "运行日志.txt"), 'a', encoding='utf-8') as log, contextlib.redirect_stdout(log):
+        store, metrics, run = collect(config, keywords, workdir, shard_rows(len(keywords), shards, shard))
+        store.close()
+        metrics.save(os.path.join(workdir, "请求统计.json"), shard=shard, **run)
+        metrics.close()
+    return shard, run
+
+
+def merge_shards(config, filepath, gtrendhtmlpath, shards):
+    """把各分片的结果并入报告目录的数据库, 按输入顺序导出与单进程相同的报告
+
+    返回 (缺少结果的分片, 报告中没有结果的主题)
+    """
+    df_subj = read_subjects(filepath)
+    keywords = list(df_subj[df_subj.columns[0]])
+    store = ReportStore(os.path.join(gtrendhtmlpath, "主题趋势报告.sqlite"))
+    store.prune(keywords)
+    missing = list()
+    for shard in range(shards):
+        path = os.path.join(shard_dir(gtrendhtmlpath, shard), "主题趋势报告.sqlite")
+        if os.path.exists(path):
+            store.merge(path)
+        else:
+            missing.append(shard)
+    metrics = Metrics()
+    export(config, store, metrics, gtrendhtmlpath, df_subj)
+    unsaved = store.missing(keywords)
+    store.close()
+    return missing, unsaved
 
-    htmlfolderpath = gtrendhtmlpath + "趋势图" + "\\"
-    if not os.path.isdir(htmlfolderpath):
-        os.mkdir(htmlfolderpath)
 
-    relatedtopicpath = gtrendhtmlpath + "相关主题" + "\\"
-    if not os.path.isdir(relatedtopicpath):
-        os.mkdir(relatedtopicpath)
+def run_single(config, filepath, gtrendhtmlpath):
+    """单进程处理整个表格并导出报告, 返回本次运行信息"""
+    df_subj = read_subjects(filepath)
 
     # df_subj = pd.read_excel("subject.xlsx")
     print(df_subj)
-    notrendlist = list()
-    trendlist = list()
-    norelated5ylist = list()
-    norelated7dlist = list()
-    related5ylist = list()
-    related7dlist = list()
-    trendurl = list()
-    topicurl = list()
     colname = df_subj.columns.values
-    # '''
-    print("\n开始获取数据...")
-    time_start = time.time()
-    trends = GtrendReq(hl=config["hl"], tz=config["tz"], retries=config["retries"])
-    trends.headers = headers
-    # input(trends.retries)
-    for i in range(len(df_subj)):
-        # if i != 0:
-        #     continue
+    keywords = list(df_subj[colname[0]])
 
-        try:
-            #  五年趋势
-            print("{}-{}:".format(i + 1, df_subj[colname[0]][i]))
-            print("请求5年POST...")
-            postflag = trends.build_payload([df_subj[colname[0]][i]], timeframe="today 5-y")
-            if not postflag:
-                raise NameError("{}:POST请求异常".format(df_subj[colname[0]][i]))
-        except NameError as e:
-            # print(repr(e))
-            print("{}:请求5年POST异常".format(df_subj[colname[0]][i]))
-            notrendlist.append(df_subj[colname[0]][i] + "POST请求异常, 请检查主题")
-            norelated5ylist.append(df_subj[colname[0]][i] + "POST请求异常, 请检查主题")
-            norelated7dlist.append(df_subj[colname[0]][i] + "POST请求异常, 请检查主题")
-            trendurl.append(None)
-            topicurl.append(None)
-            print("#=============================================================================\n")
-            continue
+    store, metrics, run = collect(config, keywords, gtrendhtmlpath)
+    export(config, store, metrics, gtrendhtmlpath, df_subj)
+    store.close()
+    metrics.save(os.path.join(gtrendhtmlpath, "请求统计.json"), **run)
+    metrics.close()
+    print_metrics(metrics)
+    return run
 
-        print("\n请求5年趋势...")
-        df = trends.interest_over_time()
-        trendurl.append(GtrendReq.INTEREST_OVER_TIME_URL + "?" + trends.prepare_gettrend_url)
-        if df is None:
-            notrendlist.append(df_subj[colname[0]][i] + "超时异常")
-            norelated5ylist.append(df_subj[colname[0]][i] + "超时异常")
-            norelated7dlist.append(df_subj[colname[0]][i] + "超时异常")
-            continue
 
-        if df.empty:
-            print("该主题无趋势")
-            notrendlist.append(df_subj[colname[0]][i])
-            norelated5ylist.append(df_subj[colname[0]][i])
-        else:
-            # 绘制图形
-            df = df.reset_index()
-            gtrendplotly(df, htmlfolderpath)
-            trendlist.append(df_subj[colname[0]][i])
+def run_sharded(config, filepath, gtrendhtmlpath, shards, only=None, merge=True, merge_only=False):
+    """多进程分片运行, 每个分片一个子进程, 完成后合并为一份报告; 返回退出码"""
+    # 分片数决定每个分片负责的行, 记录下来防止重跑时用了不同的分片数
+    manifest_path = os.path.join(gtrendhtmlpath, "分片", "分片.json")
+    os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+    if os.path.exists(manifest_path):
+        with open(manifest_path, encoding='utf-8') as fd:
+            manifest = json.load(fd)
+        if manifest['shards'] != shards:
+            print("之前以 --shards {} 运行, 分片数须保持不变(或删除 {})".format(manifest['shards'], manifest_path),
+                  file=sys.stderr)
+            return EXIT_USAGE
+    else:
+        with open(manifest_path, 'w', encoding='utf-8') as fd:
+            json.dump({'file': os.path.abspath(filepath), 'shards': shards}, fd, ensure_ascii=False)
 
-            # 获取相关主题
-            print("\n请求5年相关主题...")
-            related_topics_5y = trends.related_topics()
-            if related_topics_5y is None:
-                norelated5ylist.append(df_subj[colname[0]][i] + "超时异常")
-            else:
-                if not related_topics_5y[df_subj[colname[0]][i]]["rising"].empty and not \
-                        related_topics_5y[df_subj[colname[0]][i]]["top"].empty:
-                    writer = pd.ExcelWriter(relatedtopicpath + df_subj[colname[0]][i] + "-risingtop.xlsx",
-                                            engine='openpyxl')
-                    if related_topics_5y[df_subj[colname[0]][i]]["rising"].empty:
-                        print("该主题无5年相关上升主题")
-                    else:
-                        related_topics_5y[df_subj[colname[0]][i]]["rising"].to_excel(writer, index=False,
-                                                                                     sheet_name="rising-5year")
-
-                    if related_topics_5y[df_subj[colname[0]][i]]["top"].empty:
-                        print("该主题无5年相关热门主题")
-                    else:
-                        related_topics_5y[df_subj[colname[0]][i]]["top"].to_excel(writer, index=False,
-                                                                                  sheet_name="top-5year")
-                    writer.save()
-                    related5ylist.append(df_subj[colname[0]][i])
-                else:
-                    print("该主题无5年相关主题")
-                    norelated5ylist.append(df_subj[colname[0]][i])
-                    # input(norelated5ylist)
+    failed = list()
+    if not merge_only:
+        selected = only if only is not None else list(range(shards))
+        print("运行分片: {}, 日志见 {}".format(selected, os.path.join(gtrendhtmlpath, "分片", "<分片>", "运行日志.txt")))
+        with ProcessPoolExecutor(max_workers=len(selected)) as executor:
+            futures = {executor.submit(run_shard, config, filepath, gtrendhtmlpath, shards, shard): shard
+                       for shard in selected}
+            for future in as_completed(futures):
+                shard = futures[future]
+                try:
+                    _, run = future.result()
+                except Exception as e:
+                    print("分片{}异常: {!r}".format(shard, e))
+                    failed.append(shard)
+                    continue
+                print("分片{}完成: {}个主题, 失败{}个, 耗时{:.1f}秒".format(shard, run['keywords'], run['failed'],
+                                                                  run['seconds']))
+                if run['failed']:
+                    failed.append(shard)
+        if failed:
+            failed.sort()
+            print("以下分片未全部成功, 可单独重跑: python requestgtrend.py -i {} --shards {} --only {}".format(
+                filepath, shards, " ".join(map(str, failed))))
+    if merge_only or merge:
+        missing, unsaved = merge_shards(config, filepath, gtrendhtmlpath, shards)
+        report = os.path.join(gtrendhtmlpath, "主题趋势报告.xlsx")
+        if missing or unsaved:
+            if missing:
+                print("分片{}还没有结果".format(missing))
+            if unsaved:
+                print("报告不完整, 以下{}个主题没有结果: {}".format(len(unsaved), ", ".join(map(str, unsaved))))
+            print("已生成不完整的报告: {}".format(report))
+            return EXIT_FAILED
+        print("已生成报告: {}".format(report))
+    return EXIT_FAILED if failed else EXIT_OK
 
-        time.sleep(random.uniform(1, 3))
-        # 7天主题
-        print("\n请求7天POST...")
-        trends.build_payload([df_subj[colname[0]][i]], timeframe="now 7-d")
-        # 获取相关主题
-        print("\n请求7天相关主题...")
-        related_topics_7d = trends.related_topics()
-        topicurl.append(GtrendReq.RELATED_QUERIES_URL + "?" +trends.prepare_getrelatedtopic_url)
-        if related_topics_7d is None:
-            norelated7dlist.append(df_subj[colname[0]][i] + "超时异常")
-        else:
-            if not related_topics_7d[df_subj[colname[0]][i]]["rising"].empty or not \
-                    related_topics_7d[df_subj[colname[0]][i]]["top"].empty:
-                if os.path.exists(relatedtopicpath + df_subj[colname[0]][i] + "-risingtop.xlsx"):
-                    writer = pd.ExcelWriter(relatedtopicpath + df_subj[colname[0]][i] + "-risingtop.xlsx",
-                                            engine='openpyxl', mode='a')
-                else:
-                    writer = pd.ExcelWriter(relatedtopicpath + df_subj[colname[0]][i] + "-risingtop.xlsx",
-                                            engine='openpyxl')
-                if related_topics_7d[df_subj[colname[0]][i]]["rising"].empty:
-                    print("该主题无7天相关上升主题")
-                else:
-                    related_topics_7d[df_subj[colname[0]][i]]["rising"].to_excel(writer, index=False,
-                                                                                 sheet_name="rising-7day")
 
-                if related_topics_7d[df_subj[colname[0]][i]]["top"].empty:
-                    print("该主题无7天相关热门主题")
-                else:
-                    related_topics_7d[df_subj[colname[0]][i]]["top"].to_excel(writer, index=False,
-                                                                              sheet_name="top-7day")
-                writer.save()
-                related7dlist.append(df_subj[colname[0]][i])
-            else:
-                print("该主题无7天相关主题")
-                norelated7dlist.append(df_subj[colname[0]][i])
-                # input(norelated7dlist)
+# 退出码: 0 全部成功, 1 有主题或分片失败, 2 参数、配置或输入文件错误
+EXIT_OK, EXIT_FAILED, EXIT_USAGE = 0, 1, 2
+
 
-        os.environ["https_proxy"] = config["https_proxy"][random.randint(0, len(config["https_proxy"]) - 1)]
-        print("切换至:" + os.environ["https_proxy"] + "\n")
+def build_parser():
+    import argparse
 
-    time_end = time.time()
+    parser = argparse.ArgumentParser(
+        prog='requestgtrend.py', description='批量获取主题的Google趋势和相关主题, 生成主题趋势报告',
+        epilog='例: python requestgtrend.py -i 主题.xlsx -w 4; 大表格: python requestgtrend.py -i 主题.csv --shards 8')
+    parser.add_argument('-c', '--config', default='config.json', help='配置文件, 默认 config.json')
+    parser.add_argument('-i', '--input', help='主题表格(Excel或CSV), 第一列为主题; 不指定时在终端中交互输入')
+    parser.add_argument('-o', '--output', help='报告目录, 默认为表格同目录下的 <表格名>-主题趋势报告')
+    parser.add_argument('--trend-timeframe', help='趋势和相关主题的时间范围, 默认 "{}"'.format(TIMEFRAMES[0]))
+    parser.add_argument('--topics-timeframe', help='第二组相关主题的时间范围, 默认 "{}"'.format(TIMEFRAMES[1]))
+    parser.add_argument('-w', '--workers', type=int, help='并发线程数(共用代理池, 每个代理按 rate/burst 限速)')
+    parser.add_argument('--async', dest='async_mode', action='store_const', const=True, help='异步模式')
+    parser.add_argument('--concurrency', type=int, help='异步模式下同时请求的主题数')
+    parser.add_argument('--batch', action='store_const', const=True, help='批量模式, 每次请求4个主题加锚点主题')
+    parser.add_argument('--charts', choices=CHART_FORMATS, help='趋势图格式')
+    parser.add_argument('--incremental', action='store_const', const=True,
+                        help='增量更新趋势: 有本地历史的主题只请求最近一段并拼接')
+    parser.add_argument('--shards', type=int, help='多进程分片运行的分片数(进程数), 重跑和合并时须保持不变')
+    parser.add_argument('--only', type=int, nargs='+', help='只运行这些分片(从0开始), 用于重跑失败的分片')
+    parser.add_argument('--no-merge', dest='merge', action='store_false', help='运行分片后不合并')
+    parser.add_argument('--merge-only', action='store_true', help='不运行分片, 只合并各分片已有的结果')
+    return parser
 
-    resultwriter = pd.ExcelWriter(gtrendhtmlpath + "主题趋势报告.xlsx")
-    result = pd.concat([pd.DataFrame({'有趋势图的主题': trendlist}),
-                        pd.DataFrame({'5年有相关主题的主题': related5ylist}),
-                        pd.DataFrame({'7天有相关主题的主题': related7dlist})], axis=1)
-    result.to_excel(resultwriter, sheet_name="有趋势图", index=False)
 
-    result1 = pd.concat([pd.DataFrame({'无趋势图的主题': notrendlist}),
-                         pd.DataFrame({'5年无相关主题的主题': norelated5ylist}),
-                         pd.DataFrame({'7天无相关主题的主题': norelated7dlist})], axis=1)
-    result1.to_excel(resultwriter, sheet_name="无趋势图", index=False)
+def main(argv=None):
+    """命令行入口, 返回退出码; 没有 --input 且在终端中运行时按原来的方式提示输入"""
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    interactive = args.input is None
+    if interactive and not sys.stdin.isatty():
+        parser.error('非交互运行时需要 --input')
+    if args.shards is None and (args.only is not None or args.merge_only or not args.merge):
+        parser.error('--only/--no-merge/--merge-only 需要 --shards')
+    if args.shards is not None and (args.shards < 1 or any(not 0 <= shard < args.shards for shard in args.only or ())):
+        parser.error('--shards 须大于0, --only 的分片须在 0 到 {} 之间'.format(args.shards - 1))
 
-    result2 = pd.concat([df_subj,
-                         pd.DataFrame({'获取趋势url': trendurl}),
-                         pd.DataFrame({'获取7天主题url': topicurl})], axis=1)
-    result2.to_excel(resultwriter, sheet_name="url", index=False)
+    try:
+        config = configfunc(args.config, interactive)
+    except (OSError, ValueError) as e:
+        print("配置文件错误: {}".format(e), file=sys.stderr)
+        return EXIT_USAGE
+    overrides = {'trend_timeframe': args.trend_timeframe, 'topics_timeframe': args.topics_timeframe,
+                 'workers': args.workers, 'async': args.async_mode, 'concurrency': args.concurrency,
+                 'batch': args.batch, 'charts': args.charts, 'incremental': args.incremental}
+    config.update({key: value for key, value in overrides.items() if value is not None})
 
-    resultwriter.save()
+    filepath = args.input
+    if interactive:
+        filepath = input("文件路径:\n")
+        filepath = filepath.replace("\'", "").replace("\"", "")
+    if not os.path.isfile(filepath):
+        print("找不到主题表格: {}".format(filepath), file=sys.stderr)
+        return EXIT_USAGE
+    gtrendhtmlpath = args.output or report_dir(filepath)
+    os.makedirs(gtrendhtmlpath, exist_ok=True)
 
-    input("已生成报告, 耗时时间:{}, 平均耗时:{}, 按回车键结束".format(time_end - time_start, (time_end - time_start) / len(df_subj)))
+    if args.shards is not None:
+        return run_sharded(config, filepath, gtrendhtmlpath, args.shards, args.only, args.merge, args.merge_only)
+
+    run = run_single(config, filepath, gtrendhtmlpath)
+    elapsed = run['seconds']
+    processed = run['keywords']
+    if processed:
+        message = "已生成报告, 耗时时间:{}, 平均耗时:{}, 吞吐量:{:.2f}个主题/分钟".format(
+            elapsed, elapsed / processed, processed / elapsed * 60)
+    else:
+        # 所有主题都已完成, 只重新导出了报告
+        message = "已生成报告, 耗时时间:{}, 没有需要请求的主题".format(elapsed)
+    if run['failed']:
+        message += ", 失败{}个主题(重新运行会跳过已成功的主题)".format(run['failed'])
+    if interactive:
+        input(message + ", 按回车键结束")
+    else:
+        print(message)
+    return EXIT_FAILED if run['failed'] else EXIT_OK
 
 
 if __name__ == "__main__":
     # test()
-    main()
+    sys.exit(main())
 
     '''
     df = pd.read_excel(r"F:\JetBrains\officeTools\googletrend\subject-主题趋势报告\主题趋势报告.xlsx")